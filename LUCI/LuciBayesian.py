@@ -1,6 +1,8 @@
 from LUCI.LuciFunctions import Gaussian, Sinc, SincGauss
 import numpy as np
 
+MODELS = {'gaussian': Gaussian(), 'sinc': Sinc(), 'sincgauss': SincGauss()}  # Model evaluators (created once)
+
 
 def log_likelihood_bayes(theta, axis_restricted, spectrum_restricted, yerr, model_type, line_num, sinc_width, vel_rel,
                          sigma_rel):
@@ -18,10 +20,17 @@ def log_likelihood_bayes(theta, axis_restricted, spectrum_restricted, yerr, mode
         vel_rel:
         sigma_rel
 
+    The fit parameters can either be a single set of parameters or an array with shape (n_walkers, n_dim)
+    in which case the likelihood is evaluated for every walker at once.
+
     Return:
         Gaussian log likelihood function evaluation
     """
     model = 0  # Initialize
+    theta = np.asarray(theta)
+    # Put the parameter axis first so that theta_lines[3*i:3*(i+1)] selects the parameters of line i
+    # for every walker; the trailing axis lets each parameter broadcast against the spectral axis
+    theta_lines = theta.T[..., None]
     '''unique_vel_ct = 0  # Ct of how many uniques used for velocity
     unique_broad_ct = 0  # Ct of how many uniques used for broadening
     for line_ct in range(line_num):  # Each line
@@ -50,19 +59,17 @@ def log_likelihood_bayes(theta, axis_restricted, spectrum_restricted, yerr, mode
         elif model_type == 'sincgauss':
             model = SincGauss().evaluate_bayes(axis_restricted, theta_line, sinc_width)'''
     # Add constant contimuum to model
-    if model_type == 'gaussian':
-        model = Gaussian().evaluate(axis_restricted, theta, line_num)
-    elif model_type == 'sinc':
-        model = Sinc().evaluate(axis_restricted, theta, line_num, sinc_width)
-    elif model_type == 'sincgauss':
-        model = SincGauss().evaluate(axis_restricted, theta, line_num, sinc_width)
-    model += theta[-1]
+    model_args = (line_num,) if model_type == 'gaussian' else (line_num, sinc_width)
+    model = MODELS[model_type].evaluate(axis_restricted, theta_lines, *model_args)
+    model += theta[..., -1, None]
     sigma2 = yerr ** 2
-    val = 0.5 * np.sum((spectrum_restricted - model) ** 2 / sigma2) + np.log(2 * np.pi * sigma2)
-    if np.isnan(val):
-        return -np.inf
-    else:
-        return val
+    # Calculate the residuals in place and reduce them with a dot product to avoid temporary arrays
+    residual = np.subtract(spectrum_restricted, model, out=model)
+    val = 0.5 * np.einsum('...i,...i->...', residual, residual) / sigma2 + np.log(2 * np.pi * sigma2)
+    val = np.where(np.isnan(val), -np.inf, val)
+    if theta.ndim == 1:
+        return float(val)
+    return val
 
 
 def log_prior(theta, axis_restricted, line_num, line, line_dict, mu_vel, mu_broad, sigma_vel, sigma_broad):
@@ -80,7 +87,7 @@ def log_prior(theta, axis_restricted, line_num, line, line_dict, mu_vel, mu_broa
     TODO: The velocity and broadening need to be updated to be in cm^-1 using the formulas in LuciDocs
 
     Args:
-        theta: Fit parameters
+        theta: Fit parameters (either a single set of parameters or an array with shape (n_walkers, n_dim))
         axis_restricted:
         line_nun: Number of lines for fit
 
@@ -93,41 +100,25 @@ def log_prior(theta, axis_restricted, line_num, line, line_dict, mu_vel, mu_broa
     A_max = 1.25
     continuum_min = 0
     continuum_max = .75
-    val_prior = 0
-    within_bounds = True  # Boolean to determine if parameters are within bounds
-    line_num = -1  # Current line  -- initialization
-    for ct, param in enumerate(theta):
-        if ct % 3 == 0:  # Amplitude parameter & continuum parameter
-            line_num += 1
-            if param > A_min and param < A_max:
-                val_prior -= np.log(A_max - A_min)
-            else:
-                # print('amp: %.2E'%param)
-                within_bounds = False  # Value not in bounds
-                break
-        if ct % 3 == 1:  # velocity parameter
-            mu_vel_min = (mu_vel / 3e5 + 10 * sigma_vel / 3e5) * line_dict[line[line_num]] + line_dict[
-                line[line_num]]  # Convert to position in nm
-            mu_vel_min = 1e7 / mu_vel_min  # Convert to cm-1
-            mu_vel_max = (mu_vel / 3e5 - 10 * sigma_vel / 3e5) * line_dict[line[line_num]] + line_dict[
-                line[line_num]]  # Convert to position in nm
-            mu_vel_max = 1e7 / mu_vel_max  # Convert to cm-1
-            if param > mu_vel_min and param < mu_vel_max:
-                val_prior -= np.log(6 * sigma_vel)
-            else:
-                within_bounds = False  # Value not in bounds
-                break
-        if ct % 3 == 2:  # sigma parameter
-            if param > mu_broad - 10 * sigma_broad and param < mu_broad + 10 * sigma_broad:
-                val_prior -= np.log(10 * sigma_broad)
-            else:
-                # print('broad: %i'%param)
-                within_bounds = False  # Value not in bounds
-                break
-    if within_bounds:
-        return -val_prior
-    else:
-        return -np.inf
+    theta = np.asarray(theta)
+    thetas = np.atleast_2d(theta)
+    amps = thetas[:, 0::3]  # Amplitude parameters & continuum parameter
+    positions = thetas[:, 1::3]  # Velocity parameters
+    broads = thetas[:, 2::3]  # Sigma parameters
+    line_wvls = np.array([line_dict[line_] for line_ in line])
+    mu_vel_min = (mu_vel / 3e5 + 10 * sigma_vel / 3e5) * line_wvls + line_wvls  # Convert to position in nm
+    mu_vel_min = 1e7 / mu_vel_min  # Convert to cm-1
+    mu_vel_max = (mu_vel / 3e5 - 10 * sigma_vel / 3e5) * line_wvls + line_wvls  # Convert to position in nm
+    mu_vel_max = 1e7 / mu_vel_max  # Convert to cm-1
+    within_bounds = np.all((amps > A_min) & (amps < A_max), axis=1) & \
+                    np.all((positions > mu_vel_min) & (positions < mu_vel_max), axis=1) & \
+                    np.all((broads > mu_broad - 10 * sigma_broad) & (broads < mu_broad + 10 * sigma_broad), axis=1)
+    val_prior = -(amps.shape[1] * np.log(A_max - A_min) + positions.shape[1] * np.log(6 * sigma_vel) +
+                  broads.shape[1] * np.log(10 * sigma_broad))
+    log_prior_val = np.where(within_bounds, -val_prior, -np.inf)
+    if theta.ndim == 1:
+        return float(log_prior_val[0])
+    return log_prior_val
 
 
 def log_prior_uniform(theta, line_num, lines, line_dict):
@@ -251,7 +242,7 @@ def log_probability(theta, axis_restricted, spectrum_restricted, yerr, model_typ
     Calculate a Gaussian likelihood function given a certain fitting function: gaussian, sinc, or sincgauss
 
     Args:
-        theta: Fit parameters
+        theta: Fit parameters (either a single set of parameters or an array with shape (n_walkers, n_dim))
         axis_restricted: Wavelength axis restricted to fitting region
         spectrum_restricted: Flux values corresponded to restricted wavelength axis
         yerr: Noise in data
@@ -269,18 +260,20 @@ def log_probability(theta, axis_restricted, spectrum_restricted, yerr, model_typ
         If not finite or if an nan we return -np.inf. Otherwise, we return the log likelihood + log prior
     """
     mu_vel, mu_broad, sigma_vel, sigma_broad = prior_gauss
+    theta = np.asarray(theta)
+    thetas = np.atleast_2d(theta)  # Treat a single set of parameters as a single walker
     lp = 0
     #if mdn:
-    lp = log_prior(theta, axis_restricted, line_num, lines, line_dict, mu_vel, mu_broad, sigma_vel, sigma_broad)
+    lp = log_prior(thetas, axis_restricted, line_num, lines, line_dict, mu_vel, mu_broad, sigma_vel, sigma_broad)
     #else:
     #lp = log_prior_uniform(theta, line_num, lines, line_dict)
-    if not np.isfinite(lp):
-        return -np.inf
-    if np.isnan(lp):
-        return -np.inf
-    if np.isnan(lp + log_likelihood_bayes(theta, axis_restricted, spectrum_restricted, yerr, model_type, line_num,
-                                          sinc_width, vel_rel, sigma_rel)):
-        return -np.inf
-    else:
-        return lp + log_likelihood_bayes(theta, axis_restricted, spectrum_restricted, yerr, model_type, line_num,
-                                         sinc_width, vel_rel, sigma_rel)
+    log_prob = np.full(thetas.shape[0], -np.inf)
+    in_prior = np.isfinite(lp)  # Only evaluate the likelihood where the prior is finite
+    if np.any(in_prior):
+        log_prob[in_prior] = lp[in_prior] + log_likelihood_bayes(thetas[in_prior], axis_restricted, spectrum_restricted,
+                                                                 yerr, model_type, line_num, sinc_width, vel_rel,
+                                                                 sigma_rel)
+    log_prob[np.isnan(log_prob)] = -np.inf
+    if theta.ndim == 1:
+        return float(log_prob[0])
+    return log_prob
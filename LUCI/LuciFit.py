@@ -1,22 +1,54 @@
+from functools import lru_cache, partial
 import numpy as np
-from scipy.optimize import minimize
-from scipy import interpolate
+from scipy.optimize import minimize, least_squares
 from numdifftools import Hessian, Hessdiag
 import emcee
 import scipy.special as sps
-import astropy.stats as astrostats
 import warnings
 import dynesty
 from dynesty import utils as dyfunc
-from LUCI.LuciFunctions import Gaussian, Sinc, SincGauss, Gaussian_frozen, Sinc_frozen, SincGauss_frozen
-from LUCI.LuciFitParameters import calculate_vel, calculate_vel_err, calculate_broad, calculate_broad_err, \
+from LUCI.LuciFunctions import Gaussian, Sinc, SincGauss, nearest_index
+try:  # The frozen models are only needed when fitting with initial conditions
+    from LUCI.LuciFunctions import Gaussian_frozen, Sinc_frozen, SincGauss_frozen
+except ImportError:
+    Gaussian_frozen = Sinc_frozen = SincGauss_frozen = None
+from LUCI.LuciFitParameters import calculate_vels, calculate_vels_err, calculate_broad, calculate_broad_err, \
      calculate_flux, calculate_flux_err, calculate_vel_err_frozen, calculate_broad_err_frozen, calculate_flux_err_frozen
 from LUCI.LuciBayesian import log_probability, prior_transform, log_likelihood_bayes
+from LUCI.LuciKernels import LOG_LIKELIHOOD_KERNELS, log_likelihood_residual, chi_square
 
 warnings.filterwarnings("ignore")
 
 # Define Constants #
 SPEED_OF_LIGHT = 299792  # km/s
+# Spectral regions in cm-1 for each filter. C4 is only supported for Halpha at redshift ~0.25 where we pretend we
+# are in SN3 (LYA mods, originally the same as SN3)
+FILTER_FIT_BOUNDS = {'SN3': (14750, 15400), 'SN2': (19500, 20750), 'SN1': (26000, 27400), 'C4': (14950, 15400)}
+FILTER_NOISE_BOUNDS = {'SN3': (14500, 14600), 'SN2': (19000, 19500), 'SN1': (25700, 26300), 'C4': (14600, 14950)}
+# Lines available for the fit and their rest wavelengths in nm (the line id is the index in these arrays)
+LINE_NAMES = ('Halpha', 'NII6583', 'NII6548', 'SII6716', 'SII6731', 'OII3726', 'OII3729', 'OIII4959', 'OIII5007',
+              'Hbeta', 'OH')
+LINE_RESTS = np.array([656.280, 658.341, 654.803, 671.647, 673.085, 372.603, 372.882, 495.891, 500.684, 486.133,
+                       649.873], dtype=np.float64)
+LINE_INDEX = {name: line_id for line_id, name in enumerate(LINE_NAMES)}  # {line name: line id}
+
+
+@lru_cache(maxsize=None)
+def filter_regions(filter_name, halpha):
+    """
+    Look up the spectral regions associated with the filter of the datacube. The result is cached since it is
+    the same for every pixel of a datacube.
+
+    Args:
+        filter_name: Name of the filter (e.x. 'SN3')
+        halpha: Boolean indicating if Halpha is one of the lines being fit (required for C4)
+
+    Return:
+        Bounds of the fitting region and bounds of the noise region in cm-1 (None if the filter is not supported)
+    """
+    if filter_name in FILTER_FIT_BOUNDS and (filter_name != 'C4' or halpha):
+        return FILTER_FIT_BOUNDS[filter_name], FILTER_NOISE_BOUNDS[filter_name]
+    return None
 
 class Fit:
     """
@@ -44,7 +76,7 @@ class Fit:
                  bayes_bool=False, bayes_method='emcee',
                  uncertainty_bool=False, mdn=False,
                  nii_cons=True, sky_lines=None, sky_lines_scale=None, initial_values=False,
-                 spec_min=None, spec_max=None
+                 spec_min=None, spec_max=None, ml_priors=None
                  ):
         """
         Args:
@@ -73,31 +105,34 @@ class Fit:
             initial_values: List of initial conditions for the velocity and broadening; [velocity, broadening]
             spec_min: Minimum value of the spectrum to be considered in the fit (we find the closest value)
             spec_max: Maximum value of the spectrum to be considered in the fit
+            ml_priors: Precomputed machine learning estimates [vel_ml, broad_ml, vel_ml_sigma, broad_ml_sigma] (e.x. from
+                Fit.batch_ml_priors). If passed, the machine learning model is not called for this spectrum (default None)
         """
-        self.line_dict = {'Halpha': 656.280, 'NII6583': 658.341, 'NII6548': 654.803,
-                          'SII6716': 671.647, 'SII6731': 673.085, 'OII3726': 372.603,
-                          'OII3729': 372.882, 'OIII4959': 495.891, 'OIII5007': 500.684,
-                          'Hbeta': 486.133, 'OH': 649.873}
+        self.line_dict = dict(zip(LINE_NAMES, LINE_RESTS.tolist()))  # {line name: rest wavelength in nm}
         self.available_functions = ['gaussian', 'sinc', 'sincgauss']
         self.sky_lines = sky_lines
         self.sky_lines_scale = sky_lines_scale
         self.nii_cons = nii_cons
         self.spec_min = spec_min
         self.spec_max = spec_max
-        self.spectrum = spectrum
-        self.spectrum_clean = spectrum / np.max(spectrum)  # Clean normalized spectrum
-        self.spectrum_normalized = self.spectrum / np.max(self.spectrum)  # Normalized spectrum  Yes it is duplicated
+        self.spectrum = np.ascontiguousarray(spectrum, dtype=np.float32)  # Single precision is enough for the flux
+        self.spectrum_max = float(np.max(self.spectrum))  # Maximum of the spectrum used to normalize it
+        self.spectrum_clean = self.spectrum / self.spectrum_max  # Clean normalized spectrum
         self.axis = axis  # Redshifted axis
+        self.axis_array = np.ascontiguousarray(axis, dtype=np.float64)  # Redshifted axis as an array for lookups
         self.spectrum_restricted = None
-        self.spectrum_restricted_norm = None
         self.axis_restricted = None
+        self.min_restricted, self.max_restricted = 0, 0  # Indices of the fitting region on the axis
+        self.min_noise, self.max_noise = 0, 0  # Indices of the region used to calculate the noise on the axis
         self.wavenumbers_syn = wavenumbers_syn
         self.model_type = model_type
         self.lines = lines
         self.line_num = len(lines)  # Number of  lines to fit
         self.trans_filter = trans_filter
+        self.spectrum_scale = self.spectrum_max  # Scaling factor used to normalize spectrum
         if trans_filter is not None:
             self.apply_transmission()  # Apply transmission filter if one is provided
+            self.spectrum_scale = float(np.max(self.spectrum))
         self.filter = filter
         self.spectrum_interpolated = np.zeros_like(self.spectrum)
         self.spectrum_interp_scale = None
@@ -123,7 +158,6 @@ class Fit:
         self.bayes_bool = bayes_bool
         self.bayes_method = bayes_method
         self.uncertainty_bool = uncertainty_bool
-        self.spectrum_scale = 0.0  # Sacling factor used to normalize spectrum
         self.sinc_width = 0.0  # Width of the sinc function -- Initialize to zero
         self.calc_sinc_width()
         self.mdn = mdn
@@ -131,16 +165,30 @@ class Fit:
         self.broad_ml = 0.0  # ML Estimate of the velocity dispersion [km/s]
         self.vel_ml_sigma = 0.0  # ML Estimate for velocity 1-sigma error
         self.broad_ml_sigma = 0.0  # ML Estimate for velocity dispersion 1-sigma error
+        self.ml_priors = ml_priors
+        if ml_priors is not None:
+            self.vel_ml, self.broad_ml, self.vel_ml_sigma, self.broad_ml_sigma = [float(prior) for prior in ml_priors]
         self.initial_conditions = initial_values  # List for initial conditions (or default False)
         self.initial_values = initial_values  # List for initial values (or default False)
         self.fit_sol = np.zeros(3 * self.line_num + 1)  # Solution to the fit
         self.uncertainties = np.zeros(3 * self.line_num + 1)  # 1-sigma errors on fit parameters
+        self.fit_vector = np.zeros(len(self.axis_array), dtype=np.float32)  # Fit evaluated on the axis (filled in place)
         self.flat_samples = None
         # Check that lines inputted by user are in line_dict
         if sky_lines is None:
             self.check_lines()
         self.check_fitting_model()
         self.check_lengths()
+        # Rest wavelengths of the lines in nm (in the same order as the lines)
+        if sky_lines is None:
+            self.line_rest = LINE_RESTS[[LINE_INDEX[line] for line in self.lines]]
+        else:  # Sky lines are not in line_dict
+            self.line_rest = np.array(list(self.sky_lines.values()), dtype=np.float64)
+        # Compiled log likelihood for the model (None for sincgauss, see LOG_LIKELIHOOD_KERNELS)
+        self.log_likelihood_kernel = LOG_LIKELIHOOD_KERNELS.get(self.model_type)
+        # Bind the model once so that we do not have to check the model type each time we evaluate it
+        self.model = {'gaussian': Gaussian, 'sinc': Sinc, 'sincgauss': SincGauss}[self.model_type]()
+        self.model_args = (self.line_num,) if self.model_type == 'gaussian' else (self.line_num, self.sinc_width)
 
     def apply_transmission(self):
         """
@@ -150,8 +198,9 @@ class Fit:
         division since we have already interpolated the transition filter vector
         over the UNSHIFTED spectral axis.
         """
-        self.spectrum = [self.spectrum[i] / self.trans_filter[i] if self.trans_filter[i] > 0.5 else self.spectrum[i] for
-                         i in range(len(self.spectrum))]
+        trans_mask = self.trans_filter > 0.5  # Only correct where the filter transmits
+        self.spectrum = np.where(trans_mask, self.spectrum / np.where(trans_mask, self.trans_filter, 1.0),
+                                 self.spectrum).astype(np.float32)
 
     def calculate_correction(self):
         """
@@ -167,6 +216,18 @@ class Fit:
         MPD = self.cos_theta * self.delta_x * (self.n_steps - self.zpd_index) / 1e7
         self.sinc_width = 1 / (2 * MPD)
 
+    def filter_bounds(self):
+        """
+        Look up the spectral regions associated with the filter of the datacube (see filter_regions)
+
+        Return:
+            Bounds of the fitting region and bounds of the noise region in cm-1 (None if the filter is not supported)
+        """
+        regions = filter_regions(self.filter, 'Halpha' in self.lines)
+        if regions is None:
+            print('The filter of your datacube is not supported by LUCI. We only support SN1, SN2, and SN3 at the moment.')
+        return regions
+
     def restrict_wavelength(self):
         """
         Restrict the wavelength range of the fit so that the fit only occurs over the central regions of the spectra.
@@ -175,34 +236,21 @@ class Fit:
         # Determine filter
 
         if self.spec_min is None or self.spec_max is None:  # If the user has not entered explicit bounds
-            global bound_lower, bound_upper
-            if self.filter == 'SN3':
-                bound_lower = 14750
-                bound_upper = 15400
-            elif self.filter == 'SN2':
-                bound_lower = 19500
-                bound_upper = 20750
-            elif self.filter == 'SN1':
-                bound_lower = 26000
-                bound_upper = 27400
-            elif self.filter == 'C4' and 'Halpha' in self.lines:
-                ## This is true for objects at redshift ~0.25
-                # In this case we pretend we are in SN3
-                bound_lower = 14950  # LYA mod - originally the same as SN3 restrictions
-                bound_upper = 15400
+            regions = self.filter_bounds()
+            if regions is None:  # Fit over the entire axis
+                self.spec_min, self.spec_max = self.axis_array[0], self.axis_array[-1]
             else:
-                print(
-                    'The filter of your datacube is not supported by LUCI. We only support SN1, SN2, and SN3 at the moment.')
-            self.spec_min = bound_lower
-            self.spec_max = bound_upper
+                self.spec_min, self.spec_max = regions[0]
         else:
             pass
-        min_ = np.argmin(np.abs(np.array(self.axis) - self.spec_min))
-        max_ = np.argmin(np.abs(np.array(self.axis) - self.spec_max))
-        self.spectrum_restricted = self.spectrum_normalized[min_:max_]
-        self.axis_restricted = self.axis[min_:max_]
-        self.spectrum_restricted_norm = self.spectrum_restricted / np.max(self.spectrum_restricted)
-        return min_, max_
+        min_, max_ = nearest_index(self.axis_array, (self.spec_min, self.spec_max))
+        self.min_restricted, self.max_restricted = int(min_), int(max_)
+        # Chi squared kernel specialized to the restricted region
+        self.chi_square_restricted = partial(chi_square, min_restricted=self.min_restricted,
+                                             max_restricted=self.max_restricted)
+        self.spectrum_restricted = self.spectrum_clean[self.min_restricted:self.max_restricted]
+        self.axis_restricted = self.axis[self.min_restricted:self.max_restricted]
+        return self.min_restricted, self.max_restricted
 
     def calculate_noise(self):
         """
@@ -212,29 +260,14 @@ class Fit:
         is what is passed to the fit function.
         """
         # Determine filter
-        global bound_lower, bound_upper
-        if self.filter == 'SN3':
-            bound_lower = 14500  # 16000
-            bound_upper = 14600  # 16400
-        elif self.filter == 'SN2':
-            bound_lower = 19000
-            bound_upper = 19500
-        elif self.filter == 'SN1':
-            bound_lower = 25700
-            bound_upper = 26300
-        elif self.filter == 'C4' and 'Halpha' in self.lines:
-            ## This is true for objects at redshift ~0.25
-            # In this case we pretend we are in SN3
-            bound_lower = 14600  # LYA mods, originally the same as SN3
-            bound_upper = 14950
-        else:
-            print(
-                'The filter of your datacube is not supported by LUCI. We only support SN1, SN2, and SN3 at the moment.')
+        regions = self.filter_bounds()
+        if regions is None:  # Keep the initial noise value
+            return None
         # Calculate standard deviation
-        min_ = np.argmin(np.abs(np.array(self.axis) - bound_lower))
-        max_ = np.argmin(np.abs(np.array(self.axis) - bound_upper))
-        spec_noise = self.spectrum_clean[min_:max_]
-        self.noise = np.nanstd(spec_noise)
+        min_, max_ = nearest_index(self.axis_array, regions[1])
+        self.min_noise, self.max_noise = int(min_), int(max_)
+        spec_noise = self.spectrum_clean[self.min_noise:self.max_noise]
+        self.noise = float(np.nanstd(spec_noise, dtype=np.float64))
 
     def estimate_priors_ML(self, mdn=True):
         """
@@ -247,35 +280,59 @@ class Fit:
         Return:
             Updates self.vel_ml
         """
-        Spectrum = self.spectrum_interp_norm.reshape(1, self.spectrum_interp_norm.shape[0], 1)
-        if self.mdn:
-            prediction_distribution = self.ML_model(Spectrum, training=False)
-            prediction_mean = prediction_distribution.mean().numpy().tolist()
-            prediction_stdv = prediction_distribution.stddev().numpy().tolist()
-            self.vel_ml = [pred[0] for pred in prediction_mean][0]
-            self.vel_ml_sigma = [pred[0] for pred in prediction_stdv][0]
-            self.broad_ml = [pred[1] for pred in prediction_mean][0]
-            self.broad_ml_sigma = [pred[1] for pred in prediction_stdv][0]
-        elif self.mdn == False:
-            predictions = self.ML_model(Spectrum, training=False)
-            self.vel_ml = float(predictions[0][0])
-            self.vel_ml_sigma = 0
-            self.broad_ml = float(predictions[0][1])
-            self.broad_ml_sigma = 0
+        vel_ml, broad_ml, vel_ml_sigma, broad_ml_sigma = self.batch_ml_priors(self.spectrum_interp_norm[np.newaxis, :],
+                                                                              self.ML_model, self.mdn)
+        self.vel_ml = float(vel_ml[0])
+        self.vel_ml_sigma = float(vel_ml_sigma[0])
+        self.broad_ml = float(broad_ml[0])
+        self.broad_ml_sigma = float(broad_ml_sigma[0])
         return None
 
+    @staticmethod
+    def batch_ml_priors(interp_norm_batch, ML_model, mdn=False):
+        """
+        Apply machine learning algorithm on a batch of spectra at once in order to estimate the velocity and
+        broadening of each one. Calling the network once for many spectra is much faster than calling it
+        once per spectrum. The spectra must be interpolated onto the reference spectrum axis AND
+        normalized as described in Rhea et al. 2020a (see interpolate_spectrum).
+
+        Args:
+            interp_norm_batch: Interpolated and normalized spectra (numpy array with shape (n_spectra, n_channels))
+            ML_model: Tensorflow/keras machine learning model
+            mdn: Boolean to determine which network to use (if true use MDN if false use standard CNN)
+
+        Return:
+            Arrays of the velocity, broadening, velocity 1-sigma error, and broadening 1-sigma error estimates
+            (the errors are zero if not using the MDN)
+        """
+        Spectra = np.asarray(interp_norm_batch)
+        Spectra = Spectra.reshape(Spectra.shape[0], Spectra.shape[1], 1)
+        if mdn:
+            prediction_distribution = ML_model(Spectra, training=False)
+            prediction_mean = prediction_distribution.mean().numpy()
+            prediction_stdv = prediction_distribution.stddev().numpy()
+            return prediction_mean[:, 0], prediction_mean[:, 1], prediction_stdv[:, 0], prediction_stdv[:, 1]
+        predictions = np.asarray(ML_model(Spectra, training=False))  # Single conversion out of tensorflow
+        no_errors = np.zeros(Spectra.shape[0])
+        return predictions[:, 0], predictions[:, 1], no_errors, no_errors
+
     def interpolate_spectrum(self):
         """
         Interpolate Spectrum given the wavelength axis of reference spectrum.
         Then normalize the spectrum so that the max value equals 1
 
         Return:
-            Populates self.spectrum_interpolated, self.spectrum_scale, and self.spectrum_interp_norm.
+            Populates self.spectrum_interpolated and self.spectrum_interp_norm.
 
         """
-        self.spectrum_scale = np.max(self.spectrum)
-        f = interpolate.interp1d(self.axis, self.spectrum, kind='slinear')
-        self.spectrum_interpolated = f(self.wavenumbers_syn)
+        axis, spectrum = self.axis_array, self.spectrum
+        if axis[0] > axis[-1]:  # np.interp requires an increasing axis
+            axis, spectrum = axis[::-1], spectrum[::-1]
+        # np.interp would silently use the edge values outside of the axis (interp1d raised an error)
+        if np.min(self.wavenumbers_syn) < axis[0] or np.max(self.wavenumbers_syn) > axis[-1]:
+            raise ValueError('The reference axis ({}, {}) is outside of the spectral axis ({}, {}).'.format(
+                np.min(self.wavenumbers_syn), np.max(self.wavenumbers_syn), axis[0], axis[-1]))
+        self.spectrum_interpolated = np.interp(self.wavenumbers_syn, axis, spectrum)
         self.spectrum_interp_scale = np.max(self.spectrum_interpolated)
         self.spectrum_interp_norm = self.spectrum_interpolated / self.spectrum_interp_scale
         return None
@@ -293,7 +350,7 @@ class Fit:
             Estimated line amplitude in units of cm-1 (line_amp_est) and estimate line position in units of cm-1 (line_pos_est)
 
         """
-        line_theo = self.line_dict[line_name]
+        line_theo = LINE_RESTS[LINE_INDEX[line_name]]
         if self.ML_model is None or self.ML_model == '':
             if self.initial_values is not False:
                 print(self.initial_values)
@@ -304,21 +361,9 @@ class Fit:
         else:
             pass  # vel_ml and broad_ml already set using ML algorithm
         line_pos_est = 1e7 / ((self.vel_ml / SPEED_OF_LIGHT) * line_theo + line_theo)  # Estimate of position of line in cm-1
-        line_ind = np.argmin(np.abs(np.array(self.axis) - line_pos_est))
-        try:
-            line_amp_est = np.max([
-                #self.spectrum_normalized[line_ind - 4],
-                self.spectrum_normalized[line_ind - 3],
-                self.spectrum_normalized[line_ind - 2],
-                self.spectrum_normalized[line_ind - 1],
-                self.spectrum_normalized[line_ind],
-                self.spectrum_normalized[line_ind + 1],
-                self.spectrum_normalized[line_ind + 2],
-                self.spectrum_normalized[line_ind + 3],
-                #self.spectrum_normalized[line_ind + 4]
-            ])
-        except:
-            line_amp_est = self.spectrum_normalized[line_ind]
+        line_ind = int(nearest_index(self.axis_array, line_pos_est))
+        # Take the maximum within three channels of the line position (the slice is clipped at the edges)
+        line_amp_est = np.max(self.spectrum_clean[max(line_ind - 3, 0): line_ind + 4])
         line_broad_est = (line_pos_est * self.broad_ml) / (SPEED_OF_LIGHT)
         if self.mdn:
             # Update position and sigma_gauss bounds -- looks gross but it's the usual transformation
@@ -346,7 +391,7 @@ class Fit:
         """
         # Define continuum regions
         min_ = 0
-        max_ = 1e6
+        max_ = len(self.spectrum_restricted)
         if self.filter == 'SN3':
             min_ = 14950
             max_ = 15050
@@ -358,9 +403,12 @@ class Fit:
             max_ = 26250
 
         # Clip values at given sigma level (defined by sigma_level)
-        clipped_spec = astrostats.sigma_clip(self.spectrum_restricted[min_:max_], sigma=sigma_level,
-                                             masked=False, copy=False,
-                                             maxiters=3, stdfunc=astrostats.mad_std)
+        # We do a single pass using the median absolute deviation (scaled to a standard deviation)
+        clipped_spec = self.spectrum_restricted[min_:max_]
+        if len(clipped_spec) > 0:
+            med = np.nanmedian(clipped_spec)
+            mad_std = 1.4826 * np.nanmedian(np.abs(clipped_spec - med))
+            clipped_spec = clipped_spec[np.abs(clipped_spec - med) <= sigma_level * mad_std]
         if len(clipped_spec) < 1:
             clipped_spec = self.spectrum_restricted
         # Now take the minimum value to serve as the continuum value
@@ -381,12 +429,12 @@ class Fit:
         """
         model = 0
         if self.initial_conditions is False:
-            if self.model_type == 'gaussian':
-                model = Gaussian().evaluate(self.axis_restricted, theta, self.line_num)
-            elif self.model_type == 'sinc':
-                model = Sinc().evaluate(self.axis_restricted, theta, self.line_num, self.sinc_width)
-            elif self.model_type == 'sincgauss':
-                model = SincGauss().evaluate(self.axis_restricted, theta, self.line_num, self.sinc_width)
+            if self.log_likelihood_kernel is None:  # sincgauss: only the reduction is compiled
+                model = self.model.evaluate(self.axis_restricted, theta, *self.model_args) + theta[-1]
+                return log_likelihood_residual(self.spectrum_restricted, model, self.noise)
+            return self.log_likelihood_kernel(self.axis_restricted, self.spectrum_restricted,
+                                              np.asarray(theta, dtype=np.float64), self.line_num,
+                                              self.sinc_width, self.noise)
         else:
             if self.model_type == 'gaussian':
                 model = Gaussian_frozen(self.initial_conditions[0][0],self.initial_conditions[1][0], self.lines).evaluate(self.axis_restricted, theta, self.line_num)
@@ -401,50 +449,253 @@ class Fit:
         #return np.sum(stats.norm.logpdf(self.spectrum_restricted, loc=model, scale=sigma2))
         return -0.5 * np.sum((self.spectrum_restricted - model) ** 2 / sigma2) + np.log(2 * np.pi * sigma2)
 
+    def model_jacobian(self, theta):
+        """
+        Calculate the partial derivatives of the model (including the continuum constant) with respect to
+        each fit parameter on the restricted axis
 
-    def sigma_constraints(self):
+        Args:
+            theta: List of parameters for all the models in the following order
+                            [amplitude, line location, sigma, continuum constant]
+        Return:
+            Array of partial derivatives with shape (3*line_num+1, len(axis_restricted))
+
+        """
+        jac = np.ones((3 * self.line_num + 1, len(self.axis_restricted)))  # The continuum derivative is one
+        jac[:-1] = self.model.jacobian(self.axis_restricted, theta, *self.model_args)
+        return jac
+
+    def grad_log_likelihood(self, theta):
+        """
+        Calculate the analytic gradient of the log likelihood function with respect to the fit parameters.
+        This is passed to the minimizer so that it does not need to estimate the gradient with finite differences.
+
+        Args:
+            theta: List of parameters for all the models in the following order
+                            [amplitude, line location, sigma, continuum constant]
+                    The continuum constant is always the last argument regardless of the number of lines being modeled
+        Return:
+            Gradient of the log likelihood (same length as theta)
+
+        """
+        theta = np.asarray(theta, dtype=np.float64)
+        jac = self.model_jacobian(theta)
+        # Every model is linear in its amplitude so the model is the amplitudes times their derivatives
+        residual = theta[:-1:3] @ jac[:-1:3]
+        # Calculate the weighted residuals in place
+        np.subtract(self.spectrum_restricted, residual, out=residual)
+        residual -= theta[-1]
+        residual /= self.noise ** 2
+        return jac @ residual
+
+    def calculate_uncertainties(self, theta, param_jac=None):
+        """
+        Calculate the 1-sigma uncertainties on the fit parameters. The covariance matrix is the negative inverse
+        Hessian of the log likelihood which we approximate with the Gauss-Newton form, H = -J^T J / noise^2,
+        where J is the Jacobian of the model. This only requires the analytic Jacobian at the solution.
+
+        Args:
+            theta: Solution of the fit on the normalized spectrum
+            param_jac: Derivative of theta with respect to the free parameters (see expand_parameters). If passed,
+                the covariance of the free parameters is propagated to all parameters (default None)
+        Return:
+            1-sigma uncertainties on each parameter
+
+        """
+        jac = self.model_jacobian(theta)
+        if param_jac is not None:
+            jac = param_jac.T @ jac  # Jacobian with respect to the free parameters
+        fisher_mat = jac @ jac.T / self.noise ** 2  # Negative Hessian of the log likelihood
+        try:
+            covariance_mat = np.linalg.inv(fisher_mat)
+        except np.linalg.LinAlgError:
+            covariance_mat = np.linalg.pinv(fisher_mat)
+        if param_jac is not None:
+            covariance_mat = param_jac @ covariance_mat @ param_jac.T
+        return np.sqrt(np.abs(np.diagonal(covariance_mat)))
+
+    def setup_parameter_ties(self):
+        """
+        Set up the parameter elimination used by the least squares fit. Instead of constraining the tied velocities,
+        broadenings, and NII doublet amplitudes, we only fit the free parameters and calculate the tied ones from them.
+        Parameters that are neither free nor tied keep their initial values.
+
+        Return:
+            Populates self.free_params (indices of the free parameters in theta) and the ties
+        """
+        vel_0, vel_tied = self.tied_line_pairs(self.vel_rel)
+        sigma_0, sigma_tied = self.tied_line_pairs(self.sigma_rel)
+        # Equal velocities means the ratio of the line positions is the inverse ratio of the rest wavelengths
+        self.vel_ties = (3 * vel_0 + 1, 3 * vel_tied + 1, self.line_rest[vel_0] / self.line_rest[vel_tied])
+        self.sigma_ties = (3 * sigma_0 + 2, 3 * sigma_tied + 2)
+        self.nii_tie = None
+        tied = list(3 * vel_tied + 1) + list(3 * sigma_tied + 2)
+        if self.model_type == 'sinc':  # The width of the sinc is fixed so we keep the broadening at its initial value
+            tied += list(3 * np.arange(self.line_num) + 2)
+        if 'NII6548' in self.lines and 'NII6583' in self.lines and self.nii_cons is True:
+            self.nii_tie = (list(self.lines).index('NII6583'), list(self.lines).index('NII6548'))
+            tied.append(3 * self.nii_tie[1])
+        self.free_params = np.setdiff1d(np.arange(3 * self.line_num + 1), tied)
+
+    def nii_weight(self, sigma):
+        """
+        Factor multiplying the amplitude in the NII doublet constraint (see NII_constraints) and its derivative
+
+        Args:
+            sigma: Broadening of the line
+
+        Return:
+            Weight and its derivative with respect to sigma
+        """
+        if self.model_type == 'sincgauss':
+            erf_ = sps.erf(sigma / (np.sqrt(2) * self.sinc_width))
+            weight = np.sqrt(2 * np.pi) * sigma / erf_
+            d_erf = np.sqrt(2 / np.pi) * np.exp(-sigma ** 2 / (2 * self.sinc_width ** 2)) / self.sinc_width
+            return weight, np.sqrt(2 * np.pi) * (erf_ - sigma * d_erf) / erf_ ** 2
+        return sigma, 1.0
+
+    def expand_parameters(self, params_free):
+        """
+        Calculate all the fit parameters from the free parameters (see setup_parameter_ties)
+
+        Args:
+            params_free: Values of the free parameters
+
+        Return:
+            Full parameter vector theta and its derivative with respect to the free parameters
+        """
+        theta = np.array(self.initial_values, dtype=np.float64)
+        param_jac = np.zeros((3 * self.line_num + 1, len(self.free_params)))
+        theta[self.free_params] = params_free
+        param_jac[self.free_params, np.arange(len(self.free_params))] = 1.0
+        # Tied line positions
+        pos_0, pos_tied, ratio = self.vel_ties
+        theta[pos_tied] = ratio * theta[pos_0]
+        param_jac[pos_tied] = ratio[:, None] * param_jac[pos_0]
+        # Tied broadening (sigma / line position is the same for every line in a group)
+        sig_0, sig_tied = self.sigma_ties
+        sig_ratio = theta[sig_tied - 1] / theta[sig_0 - 1]
+        theta[sig_tied] = sig_ratio * theta[sig_0]
+        param_jac[sig_tied] = sig_ratio[:, None] * param_jac[sig_0] + \
+                              (theta[sig_tied] / theta[sig_tied - 1])[:, None] * param_jac[sig_tied - 1] - \
+                              (theta[sig_tied] / theta[sig_0 - 1])[:, None] * param_jac[sig_0 - 1]
+        # Tied NII6548 amplitude
+        if self.nii_tie is not None:
+            ind_6583, ind_6548 = self.nii_tie
+            weight_6583, d_weight_6583 = self.nii_weight(theta[3 * ind_6583 + 2])
+            weight_6548, d_weight_6548 = self.nii_weight(theta[3 * ind_6548 + 2])
+            amp_6583 = theta[3 * ind_6583]
+            theta[3 * ind_6548] = amp_6583 * weight_6583 / (3 * weight_6548)
+            # Derivatives taken from the tie weight directly so that a zero NII6583 amplitude is fine
+            param_jac[3 * ind_6548] = weight_6583 / (3 * weight_6548) * param_jac[3 * ind_6583] + \
+                amp_6583 * d_weight_6583 / (3 * weight_6548) * param_jac[3 * ind_6583 + 2] - \
+                amp_6583 * weight_6583 * d_weight_6548 / (3 * weight_6548 ** 2) * param_jac[3 * ind_6548 + 2]
+        return theta, param_jac
+
+    def residuals(self, params_free):
+        """
+        Calculate the residuals between the model and the restricted spectrum given the free parameters
+
+        Args:
+            params_free: Values of the free parameters
+
+        Return:
+            Residuals on the restricted axis
+        """
+        theta = self.expand_parameters(params_free)[0]
+        residual = self.model.evaluate(self.axis_restricted, theta, *self.model_args)
+        # Add the continuum and subtract the spectrum in place
+        residual += theta[-1]
+        residual -= self.spectrum_restricted
+        return residual
+
+    def residuals_jacobian(self, params_free):
         """
-        Set up constraints for sigma values before fitting line
+        Calculate the Jacobian of the residuals with respect to the free parameters
+
+        Args:
+            params_free: Values of the free parameters
+
+        Return:
+            Jacobian with shape (len(axis_restricted), number of free parameters)
+        """
+        theta, param_jac = self.expand_parameters(params_free)
+        return self.model_jacobian(theta).T @ param_jac
+
+    def tied_line_pairs(self, relations):
+        """
+        Find the pairs of lines that are tied together. Every line in a group is paired with the first line of the group.
+
+        Args:
+            relations: List of group labels for each line (e.x. self.sigma_rel or self.vel_rel)
+
         Return:
-            Dictionary describing constraints
+            Indices of the first line of the group and indices of the lines tied to it
         """
-        sigma_dict_list = []
-        unique_rels = np.unique(self.sigma_rel)  # List of unique groups
+        inds_0 = []
+        inds_tied = []
+        unique_rels = np.unique(relations)  # List of unique groups
         for unique_ in unique_rels:  # Step through each unique group
-            inds_unique = [i for i, e in enumerate(self.sigma_rel) if e == unique_]  # Obtain line indices in group
-            if len(inds_unique) > 1:  # If there is more than one element in the group
-                ind_0_ = inds_unique[0]  # Get first element
-                for ind_unique_ in inds_unique[1:]:  # Step through group elements except for the first one
-                    sigma_dict_list.append({'type': 'eq', 'fun': lambda x, ind_unique=ind_unique_, ind_0=ind_0_:
-                    (SPEED_OF_LIGHT * x[3 * ind_0 + 2]) / x[3 * ind_0 + 1] -
-                    (SPEED_OF_LIGHT * x[3 * ind_unique + 2]) / x[3 * ind_unique + 1]}
-                                           )
-        return sigma_dict_list
+            inds_unique = [i for i, e in enumerate(relations) if e == unique_]  # Obtain line indices in group
+            for ind_unique in inds_unique[1:]:  # Step through group elements except for the first one
+                inds_0.append(inds_unique[0])
+                inds_tied.append(ind_unique)
+        return np.array(inds_0, dtype=int), np.array(inds_tied, dtype=int)
+
+    def sigma_constraints(self):
+        """
+        Set up constraints for sigma values before fitting line. All the tied pairs are gathered into a single
+        vector constraint with an analytic Jacobian so the minimizer only makes one call per iteration.
+
+        Return:
+            List with the dictionary describing constraints (empty if no lines are tied)
+        """
+        inds_0, inds_tied = self.tied_line_pairs(self.sigma_rel)
+        if len(inds_0) == 0:
+            return []
+        pos_0, pos_tied = 3 * inds_0 + 1, 3 * inds_tied + 1  # Indices of the line positions in theta
+        rows = np.arange(len(inds_0))
+
+        def sigma_fun(x):
+            # Difference of the broadening in km/s
+            return SPEED_OF_LIGHT * (x[pos_0 + 1] / x[pos_0] - x[pos_tied + 1] / x[pos_tied])
+
+        def sigma_jac(x):
+            jac = np.zeros((len(rows), len(x)))
+            jac[rows, pos_0] = -SPEED_OF_LIGHT * x[pos_0 + 1] / x[pos_0] ** 2
+            jac[rows, pos_0 + 1] = SPEED_OF_LIGHT / x[pos_0]
+            jac[rows, pos_tied] = SPEED_OF_LIGHT * x[pos_tied + 1] / x[pos_tied] ** 2
+            jac[rows, pos_tied + 1] = -SPEED_OF_LIGHT / x[pos_tied]
+            return jac
+
+        return [{'type': 'eq', 'fun': sigma_fun, 'jac': sigma_jac}]
 
     def vel_constraints(self):
         """
-        Set up constraints for velocity values before fitting line
+        Set up constraints for velocity values before fitting line. All the tied pairs are gathered into a single
+        vector constraint with an analytic Jacobian so the minimizer only makes one call per iteration.
+
         Return:
-            Dictionary describing constraints
+            List with the dictionary describing constraints (empty if no lines are tied)
         """
-        vel_dict_list = []
-        unique_rels = np.unique(self.vel_rel)  # List of unique groups
-        for unique_ in unique_rels:  # Step through each unique group
-            inds_unique = [i for i, e in enumerate(self.vel_rel) if e == unique_]  # Obtain line indices in group
-            if len(inds_unique) > 1:  # If there is more than one element in the group
-                ind_0 = inds_unique[0]  # Get first element
-                ind_0_line = self.lines[ind_0]
-                for ind_unique in inds_unique[1:]:  # Step through group elements except for the first one
-                    ind_unique_line = self.lines[ind_unique]
-                    expr_dict = {'type': 'eq',
-                                 'fun': lambda x, ind_unique_=ind_unique, ind_0_=ind_0,
-                                               ind_unique_line_=ind_unique_line, ind_0_line_=ind_0_line:
-                                 SPEED_OF_LIGHT * ((1e7 / x[3 * ind_unique_ + 1] - self.line_dict[ind_unique_line_]) / (
-                                 self.line_dict[ind_unique_line_]))
-                                 - SPEED_OF_LIGHT * ((1e7 / x[3 * ind_0_ + 1] - self.line_dict[ind_0_line_]) / (
-                                 self.line_dict[ind_0_line_]))}
-                    vel_dict_list.append(expr_dict)
-        return vel_dict_list
+        inds_0, inds_tied = self.tied_line_pairs(self.vel_rel)
+        if len(inds_0) == 0:
+            return []
+        pos_0, pos_tied = 3 * inds_0 + 1, 3 * inds_tied + 1  # Indices of the line positions in theta
+        rest_0, rest_tied = self.line_rest[inds_0], self.line_rest[inds_tied]  # Rest wavelengths in nm
+        rows = np.arange(len(inds_0))
+
+        def vel_fun(x):
+            # Difference of the velocities in km/s; the -1 of each velocity cancels out
+            return SPEED_OF_LIGHT * 1e7 * (1 / (x[pos_tied] * rest_tied) - 1 / (x[pos_0] * rest_0))
+
+        def vel_jac(x):
+            jac = np.zeros((len(rows), len(x)))
+            jac[rows, pos_tied] = -SPEED_OF_LIGHT * 1e7 / (x[pos_tied] ** 2 * rest_tied)
+            jac[rows, pos_0] = SPEED_OF_LIGHT * 1e7 / (x[pos_0] ** 2 * rest_0)
+            return jac
+
+        return [{'type': 'eq', 'fun': vel_fun, 'jac': vel_jac}]
 
     def NII_constraints(self):
         """
@@ -453,7 +704,6 @@ class Fit:
         Return:
             Constraint on NII doublet relative amplitudes
         """
-        global func_
         nii_doublet_constraints = []
         # First we have to figure out which lines correspond to the doublet
         nii_6548_index = np.argwhere(np.array(self.lines) == 'NII6548')[0][0]
@@ -502,44 +752,69 @@ class Fit:
     def calculate_params(self):
         """
         Calculate the amplitude, position, and sigma of the line. These values are
-        calculated using the scipy.optimize.minimize function. This is called
-        on the log likelood previously described. The minimization algorithm uses
-        the SLSQP optimization implementation. We have applied standard bounds in order
-        to speed up the fitting. We also apply the fit on the normalized spectrum.
+        calculated using the scipy.optimize.least_squares function (trust region reflective)
+        with the analytic Jacobian of the model. Maximizing the log likelihood previously described is equivalent
+        to minimizing the squared residuals. The tied velocities, broadenings, and NII doublet amplitudes are
+        enforced by only fitting the free parameters (see setup_parameter_ties). If there are multiple components
+        of the same line, their inequality constraints require the SLSQP implementation of scipy.optimize.minimize
+        instead. We apply the fit on the normalized spectrum.
         We then correct the flux by un-normalizing the spectrum.
 
         """
         nll = lambda *args: -self.log_likelihood(*args)  # Negative Log Likelihood function
+        nll_jac = lambda *args: -self.grad_log_likelihood(*args)  # Gradient of Negative Log Likelihood function
         initial = np.ones((3 * self.line_num + 1))  # Initialize solution vector  (3*num_lines plus continuum)
-        bounds_ = []  # Initialize bounds used for fitting
         initial[-1] = self.cont_estimate(sigma_level=5)  # Add continuum constant and intialize it
-        lines_fit = []  # List of lines which already have been set up for fits
-        cons = None
         for mod in range(self.line_num):  # Step through each line
-            lines_fit.append(self.lines[mod])  # Add to list of lines fit
             amp_est, vel_est, sigma_est = self.line_vals_estimate(self.lines[mod])  # Estimate initial values
             initial[3 * mod] = amp_est - initial[-1]  # Subtract continuum estimate from amplitude estimate
             initial[3 * mod + 1] = vel_est  # Set wavenumber
-            initial[3 * mod + 2] = sigma_est  # Set sigma
+            # Set sigma (a non positive estimate, e.x. without a machine learning model, is replaced by the width of a
+            # spectral channel so that the fit can start)
+            initial[3 * mod + 2] = sigma_est if sigma_est > 0 else self.axis_step
         self.initial_values = initial
-        sigma_cons = self.sigma_constraints()  # Call sigma constaints
-        vel_cons = self.vel_constraints()  # Call velocity constraints
         vel_cons_multiple = self.multiple_component_vel_constraint()
-        # CONSTRAINTS
-        if 'NII6548' in self.lines and 'NII6583' in self.lines and self.nii_cons is True:  # Add additional constraint on NII doublet relative amplitudes
-            nii_constraints = self.NII_constraints()
-            cons = sigma_cons + vel_cons + vel_cons_multiple + nii_constraints
+        param_jac = None  # Derivative of the parameters with respect to the free parameters
+        if len(vel_cons_multiple) == 0:
+            # Solve the least squares problem over the free parameters only; the tied parameters are
+            # calculated from them so that the constraints are always satisfied
+            self.setup_parameter_ties()
+            initial_free = initial[self.free_params]
+            if np.all(np.isfinite(initial_free)) and np.all(np.isfinite(self.residuals(initial_free))) and \
+                    np.all(np.isfinite(self.residuals_jacobian(initial_free))):
+                # We do **not** use the interpolated spectrum here!
+                soln = least_squares(self.residuals, initial_free, jac=self.residuals_jacobian, method='trf')
+                parameters, param_jac = self.expand_parameters(soln.x)
+                parameters[2:-1:3] = np.abs(parameters[2:-1:3])  # The models only depend on the square of sigma
+            else:
+                # The fit cannot be started (e.x. a pixel without any signal) so we do not fit the pixel instead of
+                # raising an error that would stop the fit of the entire cube
+                parameters = np.full(3 * self.line_num + 1, np.nan)
         else:
-            cons = sigma_cons + vel_cons + vel_cons_multiple
-        # Call minimize! This uses the previously defined negative log likelihood function and the restricted axis
-        # We do **not** use the interpolated spectrum here!
-        soln = minimize(nll, initial,
-                        method='SLSQP',
-                        options={'disp': False, 'maxiter': 30},
-                        tol=1e-2,
-                        args=(), constraints=cons
-                        )
-        parameters = soln.x
+            # The inequality constraints on multiple components require SLSQP
+            sigma_cons = self.sigma_constraints()  # Call sigma constaints
+            vel_cons = self.vel_constraints()  # Call velocity constraints
+            # CONSTRAINTS
+            if 'NII6548' in self.lines and 'NII6583' in self.lines and self.nii_cons is True:  # Add additional constraint on NII doublet relative amplitudes
+                nii_constraints = self.NII_constraints()
+                cons = sigma_cons + vel_cons + vel_cons_multiple + nii_constraints
+            else:
+                cons = sigma_cons + vel_cons + vel_cons_multiple
+            # Call minimize! This uses the previously defined negative log likelihood function and the restricted axis
+            # We do **not** use the interpolated spectrum here!
+            soln = minimize(nll, initial,
+                            method='SLSQP', jac=nll_jac,
+                            options={'disp': False, 'maxiter': 30},
+                            tol=1e-2,
+                            args=(), constraints=cons
+                            )
+            parameters = soln.x
+        if self.uncertainty_bool is True:
+            if np.isnan(np.sum(parameters)):
+                print('nope')
+            else:
+                # Calculate uncertainties on the normalized spectrum before we unscale the parameters
+                self.uncertainties = self.calculate_uncertainties(parameters, param_jac)
         # We now must unscale the amplitude
         for i in range(self.line_num):
             parameters[i * 3] *= self.spectrum_scale
@@ -547,32 +822,10 @@ class Fit:
         # Scale continuum
         parameters[-1] *= self.spectrum_scale
         self.uncertainties[-1] *= self.spectrum_scale
-        if self.uncertainty_bool is True:
-            if np.isnan(np.sum(parameters)):
-                print('nope')
-            else:
-                # Calculate uncertainties using the negative inverse hessian  as the covariance matrix
-                hessian = Hessian(nll)
-                hessian_calc = hessian(parameters)
-                try:
-                    #hessian_calc = Hessian(nll, method='backward')   # Set method to backward to speed things up
-                    covariance_mat = -np.linalg.inv(hessian_calc)
-                    self.uncertainties = np.sqrt(np.abs(np.diagonal(covariance_mat)))
-                except np.linalg.LinAlgError:
-                    covariance_mat = -np.linalg.pinv(hessian_calc)
-                    self.uncertainties = np.sqrt(np.abs(np.diagonal(covariance_mat)))
         self.fit_sol = parameters
         # Create fit vector
-        if self.model_type == 'gaussian':
-            self.fit_vector = Gaussian().plot(self.axis, self.fit_sol[:-1], self.line_num) + self.fit_sol[-1]
-        elif self.model_type == 'sinc':
-            self.fit_vector = Sinc().plot(self.axis, self.fit_sol[:-1], self.line_num, self.sinc_width) + self.fit_sol[
-                -1]
-        elif self.model_type == 'sincgauss':
-            self.fit_vector = SincGauss().plot(self.axis, self.fit_sol[:-1], self.line_num, self.sinc_width) + \
-                              self.fit_sol[-1]
-        else:
-            print("Somehow all the checks missed the fact that you didn't enter a valid fit function...")
+        self.model.plot(self.axis, self.fit_sol[:-1], *self.model_args, out=self.fit_vector)
+        self.fit_vector += self.fit_sol[-1]
 
         return None
 
@@ -585,14 +838,14 @@ class Fit:
         to speed up the fitting. We also apply the fit on the normalized spectrum.
         We then correct the flux by un-normalizing the spectrum.
         """
+        if Gaussian_frozen is None:
+            raise Exception('The frozen models are not available in LUCI.LuciFunctions so the fit cannot be run with '
+                            'initial conditions.')
         nll = lambda *args: -self.log_likelihood(*args)  # Negative Log Likelihood function
         initial = np.ones((self.line_num + 1))  # Initialize solution vector  (3*num_lines plus continuum)
-        bounds_ = []  # Initialize bounds used for fitting
         initial[-1] = self.cont_estimate(sigma_level=5)  # Add continuum constant and initialize it
-        lines_fit = []  # List of lines which already have been set up for fits
         cons = None
         for mod in range(self.line_num):  # Step through each line
-            lines_fit.append(self.lines[mod])  # Add to list of lines fit
             amp_est = self.line_vals_estimate(self.lines[mod])[0]  # Estimate initial values
             initial[mod] = amp_est - initial[-1]  # Subtract continuum estimate from amplitude estimate
         self.initial_values = initial
@@ -656,13 +909,11 @@ class Fit:
             "broadening": Velocity Dispersion of the line in km/s (float)}
         """
         if sky_line != True:
-            if self.ML_model != None and self.initial_values is False:
+            if self.ML_model != None and self.initial_values is False and self.ml_priors is None:
                 # Interpolate Spectrum
                 self.interpolate_spectrum()
                 # Estimate the priors using machine learning algorithm
                 self.estimate_priors_ML()
-            else:
-                self.spectrum_scale = np.max(self.spectrum)
             # Apply Fit
             if self.initial_conditions is False:
                 self.calculate_params()
@@ -683,18 +934,17 @@ class Fit:
             sigmas_errors = []
             flux_errors = []
             if self.initial_conditions is False:
-                for line_ct, line_ in enumerate(self.lines):  # Step through each line
-                    ampls.append(self.fit_sol[line_ct * 3])
-                    # Calculate flux
-                    fluxes.append(calculate_flux(self.fit_sol[line_ct * 3], self.fit_sol[line_ct * 3 + 2], self.model_type,
-                                             self.sinc_width))
-                    vels.append(calculate_vel(line_ct, self.lines, self.fit_sol, self.line_dict))
-                    sigmas.append(calculate_broad(line_ct, self.fit_sol, self.axis_step))
-                    vels_errors.append(
-                        calculate_vel_err(line_ct, self.lines, self.fit_sol, self.line_dict, self.uncertainties))
-                    sigmas_errors.append(calculate_broad_err(line_ct, self.fit_sol, self.axis_step, self.uncertainties))
-                    flux_errors.append(
-                        calculate_flux_err(line_ct, self.fit_sol, self.uncertainties, self.model_type, self.sinc_width))
+                # Calculate the parameters of every line at once
+                line_inds = np.arange(self.line_num)
+                ampls = list(self.fit_sol[3 * line_inds])
+                fluxes = list(calculate_flux(self.fit_sol[3 * line_inds], self.fit_sol[3 * line_inds + 2],
+                                             self.model_type, self.sinc_width))
+                vels = list(calculate_vels(self.fit_sol, self.line_rest))
+                sigmas = list(calculate_broad(line_inds, self.fit_sol, self.axis_step))
+                vels_errors = list(calculate_vels_err(self.fit_sol, self.line_rest, self.uncertainties))
+                sigmas_errors = list(calculate_broad_err(line_inds, self.fit_sol, self.axis_step, self.uncertainties))
+                flux_errors = list(calculate_flux_err(line_inds, self.fit_sol, self.uncertainties, self.model_type,
+                                                      self.sinc_width))
                 # Collect parameters to return in a dictionary
                 fit_dict = {'fit_sol': self.fit_sol, 'fit_uncertainties': self.uncertainties,
                         'amplitudes': ampls, 'fluxes': fluxes, 'flux_errors': flux_errors, 'chi2': red_chi_sqr,
@@ -704,7 +954,7 @@ class Fit:
                         'continuum': self.fit_sol[-1], 'scale': self.spectrum_scale,
                         'vel_ml': self.vel_ml, 'vel_ml_sigma': self.vel_ml_sigma,
                         'broad_ml': self.broad_ml, 'broad_ml_sigma': self.broad_ml_sigma,
-                        'fit_vector': self.fit_vector, 'fit_axis': self.axis,
+                        'fit_vector': self.fit_vector.copy(), 'fit_axis': self.axis,
                         }
                 return fit_dict
             else:
@@ -729,11 +979,10 @@ class Fit:
                         'continuum': self.fit_sol[-1], 'scale': self.spectrum_scale,
                         'vel_ml': self.vel_ml, 'vel_ml_sigma': self.vel_ml_sigma,
                         'broad_ml': self.broad_ml, 'broad_ml_sigma': self.broad_ml_sigma,
-                        'fit_vector': self.fit_vector, 'fit_axis': self.axis,
+                        'fit_vector': self.fit_vector.copy(), 'fit_axis': self.axis,
                         }
                 return fit_dict
         else:  # Fit sky line
-            self.spectrum_scale = np.max(self.spectrum)
             # Apply Fit
             nll = lambda *args: self.log_likelihood(*args)  # Negative Log Likelihood function
             initial = np.ones(3*self.line_num + 1)
@@ -744,12 +993,9 @@ class Fit:
                 initial[3 * mod + 2] = 1
             initial[-1] = self.cont_estimate(sigma_level=5)
             self.initial_values = initial
-            sigma_cons = self.sigma_constraints()  # Call sigma constaints
-            vel_cons = self.vel_constraints()  # Call velocity constraints
-            cons = sigma_cons+vel_cons
             soln = minimize(nll, initial,method='trust-constr',
                             options={'disp': False, 'maxiter': 2000}, tol=1e-8,
-                            args=())#, constraints=cons)
+                            args=())
             parameters = soln.x
 
             # We now must unscale the amplitude
@@ -806,12 +1052,25 @@ class Fit:
                                                   self.line_dict, self.sinc_width,
                                                   [self.vel_ml, self.broad_ml, self.vel_ml_sigma, self.broad_ml_sigma],
                                                   self.vel_rel, self.sigma_rel, self.mdn
-                                                  )  # End additional args
+                                                  ),  # End additional args
+                                            vectorize=True  # Evaluate all the walkers in a single call
                                             )  # End EnsembleSampler
-            # Call Ensemble Sampler setting 2000 walks
-            sampler.run_mcmc(init_, 10000, progress=False)
-            # Obtain Ensemble Sampler results and discard first 200 walks (10%)
-            flat_samples = sampler.get_chain(discard=1000, flat=True)
+            # Burn in the walkers starting around the fit solution and then start a clean chain
+            state = sampler.run_mcmc(init_, 200, progress=False)
+            sampler.reset()
+            # Sample in blocks until the chain is longer than 50 autocorrelation times (or we reach the maximum of
+            # 10000 steps). The blocks grow with the chain (at least 100 steps) so that the autocorrelation time
+            # is not recalculated too often on long chains
+            tau = np.nan
+            while sampler.iteration < 10000:
+                n_block = min(max(100, sampler.iteration // 10), 10000 - sampler.iteration)
+                state = sampler.run_mcmc(state, n_block, progress=False)
+                tau = np.max(sampler.get_autocorr_time(tol=0))
+                if sampler.iteration > 50 * tau:
+                    break
+            # Obtain Ensemble Sampler results and discard the first two autocorrelation times
+            discard = int(2 * tau) if np.isfinite(tau) else 1000
+            flat_samples = sampler.get_chain(discard=discard, flat=True)
             parameters_med = []
             parameters_std = []
             self.flat_samples = flat_samples
@@ -834,17 +1093,11 @@ class Fit:
         parameters_med[-1] *= self.spectrum_scale
         parameters_std[-1] *= self.spectrum_scale
 
-        self.fit_sol = parameters_med
-        self.uncertainties = parameters_std
+        self.fit_sol = np.asarray(parameters_med)
+        self.uncertainties = np.asarray(parameters_std)
         # Calculate fit vector using updated values
-        if self.model_type == 'gaussian':
-            self.fit_vector = Gaussian().plot(self.axis, self.fit_sol[:-1], self.line_num) + self.fit_sol[-1]
-        elif self.model_type == 'sinc':
-            self.fit_vector = Sinc().plot(self.axis, self.fit_sol[:-1], self.line_num, self.sinc_width) + self.fit_sol[
-                -1]
-        elif self.model_type == 'sincgauss':
-            self.fit_vector = SincGauss().plot(self.axis, self.fit_sol[:-1], self.line_num, self.sinc_width) + \
-                              self.fit_sol[-1]
+        self.model.plot(self.axis, self.fit_sol[:-1], *self.model_args, out=self.fit_vector)
+        self.fit_vector += self.fit_sol[-1]
 
     def calc_chisquare(self, fit_vector, init_spectrum, init_errors, n_dof):
         """
@@ -853,7 +1106,7 @@ class Fit:
         Args:
             fit_vector: Spectrum obtained from fit
             init_spectrum: Observed spectrum
-            init_errors: Errors on observed spectrum
+            init_errors: Errors on observed spectrum (either a single value or the errors on the restricted region)
             n_dof: Number of degrees of freedom
 
         Return:
@@ -861,11 +1114,18 @@ class Fit:
             chi2dof: Reduced chi squared value
         """
         # compute the mean and the chi^2/dof
-        min_restricted, max_restricted = self.restrict_wavelength()
-        z = (init_spectrum[min_restricted: max_restricted]- fit_vector[min_restricted: max_restricted])
-        chi2 = np.sum((z ** 2)/(init_errors*self.spectrum_scale))
-        chi2dof = chi2 / (len(fit_vector[min_restricted: max_restricted]) - n_dof )
-        return chi2, chi2dof
+        inv_dof = np.divide(1.0, self.max_restricted - self.min_restricted - n_dof)  # inf instead of raising
+        # The kernel is compiled for single and double precision arrays so anything else is promoted
+        fit_vector, init_spectrum = np.asarray(fit_vector), np.asarray(init_spectrum)
+        fit_vector = fit_vector.astype(np.result_type(fit_vector, np.float32), copy=False)
+        init_spectrum = init_spectrum.astype(np.result_type(init_spectrum, np.float32), copy=False)
+        if np.ndim(init_errors) > 0:  # Errors for each channel of the restricted region
+            residuals = init_spectrum[self.min_restricted:self.max_restricted].astype(np.float64) - \
+                        fit_vector[self.min_restricted:self.max_restricted]
+            chi2 = np.sum(residuals ** 2 / (init_errors * self.spectrum_scale))
+            return chi2, chi2 * inv_dof
+        return self.chi_square_restricted(fit_vector, init_spectrum, norm=float(init_errors) * self.spectrum_scale,
+                                          inv_dof=inv_dof)
 
     def check_lines(self):
         """
@@ -875,10 +1135,10 @@ class Fit:
         Else it will throw an error
 
         """
-        if set(self.lines).issubset(self.line_dict):
-            pass
-        else:
-            raise Exception('Please submit a line name in the available list: \n {}'.format(self.line_dict.keys()))
+        missing = [line for line in self.lines if line not in LINE_INDEX]
+        if missing:
+            raise Exception('The lines {} are not available. Please submit a line name in the available list: \n {}'.format(
+                missing, list(LINE_NAMES)))
 
     def check_fitting_model(self):
         """
@@ -902,11 +1162,9 @@ class Fit:
         Else it will throw an error
 
         """
-        if len(self.vel_rel) != len(self.lines):
-            raise Exception("The argument vel_rel has %i arguments, but it should have %i arguments" % (
-                len(self.vel_rel), len(self.lines)))
-        elif len(self.sigma_rel) != len(self.lines):
-            raise Exception("The argument sigma_rel has %i arguments, but it should have %i arguments" % (
-                len(self.sigma_rel), len(self.lines)))
-        else:
-            pass
+        if len(self.vel_rel) == len(self.sigma_rel) == self.line_num:
+            return
+        for name, rel in (('vel_rel', self.vel_rel), ('sigma_rel', self.sigma_rel)):
+            if len(rel) != self.line_num:
+                raise Exception("The argument %s has %i arguments, but it should have %i arguments" % (
+                    name, len(rel), self.line_num))
@@ -36,6 +36,34 @@ def calculate_vel(ind, lines, fit_sol, line_dict):
     return v
 
 
+def calculate_vels(fit_sol, line_rest):
+    """
+    Calculate the velocity of every line at once (see calculate_vel).
+
+    Args:
+        fit_sol: Solution from fitting algorithm
+        line_rest: Rest wavelengths of the lines in nm (same order as the lines in fit_sol)
+    Return:
+        Velocities of the lines in units of km/s
+    """
+    l_calc = 1e7 / fit_sol[1:-1:3]
+    return SPEED_OF_LIGHT * (l_calc - line_rest) / line_rest
+
+
+def calculate_vels_err(fit_sol, line_rest, uncertainties):
+    """
+    Calculate the velocity error of every line at once (see calculate_vel_err).
+
+    Args:
+        fit_sol: Solution from fitting algorithm
+        line_rest: Rest wavelengths of the lines in nm (same order as the lines in fit_sol)
+        uncertaintes: Uncertainties from fitting algoritm
+    Return:
+        Velocity errors of the lines in units of km/s
+    """
+    return SPEED_OF_LIGHT * uncertainties[1:-1:3] * (1e7 / (line_rest * fit_sol[1:-1:3] ** 2))
+
+
 def calculate_vel_err(ind, lines, fit_sol, line_dict, uncertainties):
     """
     Calculate velocity error
@@ -30,6 +30,32 @@ def frozen_values(line_name, initial_values):
     line_broad = (line_pos * initial_broadening) / SPEED_OF_LIGHT
     return line_pos, line_broad
 
+def nearest_index(channel, value):
+    """
+    Find the index of the point on a monotonic axis closest to the given value(s).
+    This gives the same result as np.argmin(np.abs(channel - value)) using a binary search instead
+    of scanning the entire axis. The axis can be either increasing or decreasing.
+
+    Args:
+        channel: Wavelength Axis in cm-1 (must be monotonic)
+        value: Value or array of values to locate on the axis
+
+    Returns:
+        Index (or array of indices) of the closest point on the axis
+
+    """
+    channel = np.asarray(channel)
+    value = np.asarray(value)
+    decreasing = channel[0] > channel[-1]
+    channel_increasing = channel[::-1] if decreasing else channel
+    ind = np.clip(np.searchsorted(channel_increasing, value), 1, len(channel) - 1)
+    dist_lower = value - channel_increasing[ind - 1]
+    dist_upper = channel_increasing[ind] - value
+    if decreasing:
+        # Ties go to the upper point since it comes first on the original axis (like np.argmin)
+        return len(channel) - 1 - np.where(dist_lower < dist_upper, ind - 1, ind)
+    return np.where(dist_lower <= dist_upper, ind - 1, ind)
+
 class Gaussian:
     """
     Class encoding all functionality of the gaussian function. This includes
@@ -68,6 +94,30 @@ class Gaussian:
             f1 += self.function(channel, params)
         return f1
 
+    def jacobian(self, channel, theta, line_num):
+        """
+        Function to calculate the partial derivatives of the model with respect to each fit parameter
+
+        Args:
+            channel: Wavelength Axis in cm-1
+            theta: List of parameters for all the models in the following order
+                            [amplitude, line location, sigma]
+            line_num: Number of lines for fit
+
+        Return:
+            Array of partial derivatives with shape (3*line_num, len(channel))
+
+        """
+        jac = np.zeros((3 * line_num, len(channel)))
+        for model_num in range(line_num):
+            A, x, sigma = theta[model_num * 3:(model_num + 1) * 3]
+            dx = channel - x
+            gauss = np.exp((-dx ** 2) / (2 * sigma ** 2))
+            jac[3 * model_num] = gauss
+            jac[3 * model_num + 1] = A * gauss * dx / sigma ** 2
+            jac[3 * model_num + 2] = A * gauss * dx ** 2 / sigma ** 3
+        return jac
+
     def evaluate_bayes(self, channel, theta):
         """
         Function to initiate the model calculation for Bayesian Analysis
@@ -86,7 +136,7 @@ class Gaussian:
         f1 += self.function(channel, params)
         return f1
 
-    def plot(self, channel, theta, line_num):
+    def plot(self, channel, theta, line_num, out=None):
         """
         Function to initiate the correct number of models to fit
 
@@ -95,15 +145,19 @@ class Gaussian:
             theta: List of parameters for all the models in the following order
                             [amplitude, line location, sigma]
             line_num: Number of lines for fit
+            out: Array in which to write the result (default None creates a new array)
 
         Return:
             Value of function given input parameters (theta)
 
         """
-        f1 = 0.0
+        if out is None:
+            f1 = np.zeros(len(channel))
+        else:
+            f1 = out
+            f1.fill(0.0)
         for model_num in range(line_num):
-            min_ind = np.argmin(np.abs(channel - theta[3*model_num+1]))
-            pos_on_axis = channel[min_ind]
+            pos_on_axis = channel[nearest_index(channel, theta[3*model_num+1])]
             params = [theta[model_num * 3], pos_on_axis, theta[model_num*3 + 2]]
             f1 += self.function(channel, params)
         #f1 += theta[-1]
@@ -127,7 +181,7 @@ class Sinc:
         p1 = params[1]
         p2 = sinc_width
         u = (channel - p1) / p2
-        return [p0 * np.sinc(u_) if u_ != 0 else p0 for u_ in u]
+        return p0 * np.sinc(u)
 
     def evaluate(self, channel, theta, line_num, sinc_width):
         """
@@ -150,6 +204,33 @@ class Sinc:
             f1 += np.array(self.function(channel, params, sinc_width))
         return f1
 
+    def jacobian(self, channel, theta, line_num, sinc_width):
+        """
+        Function to calculate the partial derivatives of the model with respect to each fit parameter.
+        The sinc function does not depend on sigma so those derivatives are zero.
+
+        Args:
+            channel: Wavelength Axis in cm-1
+            theta: List of parameters for all the models in the following order
+                            [amplitude, line location, sigma]
+            line_num: Number of lines for fit
+            sinc_width: Fixed with of the sinc function
+
+        Return:
+            Array of partial derivatives with shape (3*line_num, len(channel))
+
+        """
+        jac = np.zeros((3 * line_num, len(channel)))
+        for model_num in range(line_num):
+            A = theta[model_num * 3]
+            u = (channel - theta[model_num * 3 + 1]) / sinc_width
+            sinc_u = np.sinc(u)
+            u_safe = np.where(u == 0, 1, u)
+            dsinc = np.where(u == 0, 0, (np.cos(np.pi * u) - sinc_u) / u_safe)  # Derivative of sinc with respect to u
+            jac[3 * model_num] = sinc_u
+            jac[3 * model_num + 1] = -A * dsinc / sinc_width
+        return jac
+
     def evaluate_bayes(self, channel, theta, sinc_width):
         """
         Function to initiate the model calculation for Bayesian Analysis
@@ -170,7 +251,7 @@ class Sinc:
         return f1
 
 
-    def plot(self, channel, theta, line_num, sinc_width):
+    def plot(self, channel, theta, line_num, sinc_width, out=None):
         """
         Function to initiate the correct number of models to fit
 
@@ -180,17 +261,21 @@ class Sinc:
                             [amplitude, line location, sigma]
             line_num: Number of lines for fit
             sinc_width: Fixed with of the sinc function
+            out: Array in which to write the result (default None creates a new array)
 
         Return:
             Value of function given input parameters (theta)
 
         """
-        f1 = 0.0
+        if out is None:
+            f1 = np.zeros(len(channel))
+        else:
+            f1 = out
+            f1.fill(0.0)
         for model_num in range(line_num):
-            min_ind = np.argmin(np.abs(channel - theta[3*model_num+1]))
-            pos_on_axis = channel[min_ind]
+            pos_on_axis = channel[nearest_index(channel, theta[3*model_num+1])]
             params = [theta[model_num * 3], pos_on_axis, theta[model_num*3 + 2]]
-            f1 += np.array(self.function(channel, params, sinc_width))
+            f1 += self.function(channel, params, sinc_width)
         return f1
 
 
@@ -254,6 +339,46 @@ class SincGauss:
                         f1 += self.function(channel, params, sinc_width)'''
         return np.real(f1)
 
+    def jacobian(self, channel, theta, line_num, sinc_width):
+        """
+        Function to calculate the partial derivatives of the model with respect to each fit parameter.
+        We use the derivative of the Dawson function, D'(z) = 1 - 2zD(z), and differentiate with respect
+        to the intermediate variables a and b before applying the chain rule.
+
+        Args:
+            channel: Wavelength Axis in cm-1
+            theta: List of parameters for all the models in the following order
+                            [amplitude, line location, sigma]
+            line_num: Number of lines for fit
+            sinc_width: Fixed width of the sinc function
+
+        Return:
+            Array of partial derivatives with shape (3*line_num, len(channel))
+
+        """
+        jac = np.zeros((3 * line_num, len(channel)))
+        p2 = sinc_width/np.pi
+        for model_num in range(line_num):
+            p0, p1, p3 = theta[model_num * 3:(model_num + 1) * 3]
+            a = p3/(np.sqrt(2)*p2)
+            b = (channel-p1)/(np.sqrt(2)*p3)
+            exp_pos = np.exp(2. * 1j * a * b)
+            exp_neg = np.exp(-2. * 1j * a * b)
+            dawson_pos = sps.dawsn(1j * a + b)
+            dawson_neg = sps.dawsn(1j * a - b)
+            dawson_a = sps.dawsn(1j * a)
+            numerator = dawson_pos * exp_pos + dawson_neg * exp_neg
+            denominator = 2. * dawson_a
+            dnum_db = (1 - 2 * b * dawson_pos) * exp_pos - (1 + 2 * b * dawson_neg) * exp_neg
+            dnum_da = (1j + 2 * a * dawson_pos) * exp_pos + (1j + 2 * a * dawson_neg) * exp_neg
+            dden_da = 2. * 1j + 4. * a * dawson_a
+            df_db = p0 * dnum_db / denominator
+            df_da = p0 * (dnum_da * denominator - numerator * dden_da) / denominator ** 2
+            jac[3 * model_num] = np.real(numerator / denominator)
+            jac[3 * model_num + 1] = np.real(-df_db / (np.sqrt(2) * p3))
+            jac[3 * model_num + 2] = np.real(df_da * a / p3 - df_db * b / p3)
+        return jac
+
     def evaluate_bayes(self, channel, theta, sinc_width):
         """
         Function to initiate the model calculation for Bayesian Analysis
@@ -273,7 +398,7 @@ class SincGauss:
         f1 += self.function(channel, params, sinc_width)
         return np.real(f1)
 
-    def plot(self, channel, theta, line_num, sinc_width):
+    def plot(self, channel, theta, line_num, sinc_width, out=None):
         """
         Function to initiate the correct number of models to fit
 
@@ -283,16 +408,20 @@ class SincGauss:
                             [amplitude, line location, sigma]
             line_num: Number of lines for fit
             sinc_width: Fixed with of the sinc function
+            out: Array in which to write the result (default None creates a new array)
 
         Return:
             Value of function given input parameters (theta)
 
         """
-        f1 = 0.0
+        if out is None:
+            f1 = np.zeros(len(channel))
+        else:
+            f1 = out
+            f1.fill(0.0)
         for model_num in range(line_num):
-            min_ind = np.argmin(np.abs(channel - theta[3*model_num+1]))
-            pos_on_axis = channel[min_ind]
+            pos_on_axis = channel[nearest_index(channel, theta[3*model_num+1])]
             params = [theta[model_num * 3], pos_on_axis, theta[model_num*3 + 2]]
-            f1 += self.function(channel, params, sinc_width)
-        return np.real(f1)
+            f1 += np.real(self.function(channel, params, sinc_width))
+        return f1
 
@@ -0,0 +1,187 @@
+"""
+In this file we have the numba kernels used in the hot loops of the fit. Each kernel evaluates the
+model and the log likelihood in a single pass over the spectral axis so no temporary arrays are created.
+The kernels are compiled with nogil=True so they do not hold the GIL while they run. This only covers the
+kernels themselves: the residuals and jacobians of the least squares fit are still numpy/scipy code that holds
+the GIL, so the joblib threads of LuciBase only overlap during the kernel calls (e.g. chi_square).
+"""
+import math
+import numpy as np
+from numba import njit, prange
+
+
+@njit(fastmath=True, cache=True, boundscheck=False, nogil=True, error_model='numpy')
+def log_likelihood_residual(spectrum, model, noise):
+    """
+    Calculate the log likelihood given a model that has already been evaluated on the spectral axis
+
+    Args:
+        spectrum: Flux values corresponded to restricted wavelength axis
+        model: Model evaluated on the restricted wavelength axis (including the continuum)
+        noise: Noise in data
+
+    Return:
+        Value of log likelihood
+    """
+    sigma2 = noise ** 2
+    acc = 0.0
+    for j in range(spectrum.shape[0]):
+        res = spectrum[j] - model[j]
+        acc += res * res
+    return -0.5 * acc / sigma2 + math.log(2 * math.pi * sigma2)
+
+
+@njit(fastmath=True, cache=True, boundscheck=False, nogil=True, error_model='numpy')
+def log_likelihood_gaussian(axis, spectrum, theta, line_num, sinc_width, noise):
+    """
+    Calculate the log likelihood of a sum of gaussian functions plus a constant continuum
+
+    Args:
+        axis: Wavelength axis restricted to fitting region
+        spectrum: Flux values corresponded to restricted wavelength axis
+        theta: Fit parameters [amplitude, line location, sigma, ..., continuum constant]
+        line_num: Number of lines for fit
+        sinc_width: Fixed width of the sinc function (unused; kept so all kernels share a signature)
+        noise: Noise in data
+
+    Return:
+        Value of log likelihood
+    """
+    sigma2 = noise ** 2
+    acc = 0.0
+    for j in range(axis.shape[0]):
+        model = theta[-1]
+        for i in range(line_num):
+            u = (axis[j] - theta[3 * i + 1]) / theta[3 * i + 2]
+            model += theta[3 * i] * math.exp(-0.5 * u * u)
+        res = spectrum[j] - model
+        acc += res * res
+    return -0.5 * acc / sigma2 + math.log(2 * math.pi * sigma2)
+
+
+@njit(fastmath=True, cache=True, boundscheck=False, nogil=True, error_model='numpy')
+def log_likelihood_sinc(axis, spectrum, theta, line_num, sinc_width, noise):
+    """
+    Calculate the log likelihood of a sum of sinc functions plus a constant continuum
+
+    Args:
+        axis: Wavelength axis restricted to fitting region
+        spectrum: Flux values corresponded to restricted wavelength axis
+        theta: Fit parameters [amplitude, line location, sigma, ..., continuum constant]
+        line_num: Number of lines for fit
+        sinc_width: Fixed width of the sinc function
+        noise: Noise in data
+
+    Return:
+        Value of log likelihood
+    """
+    sigma2 = noise ** 2
+    acc = 0.0
+    for j in range(axis.shape[0]):
+        model = theta[-1]
+        for i in range(line_num):
+            u = math.pi * (axis[j] - theta[3 * i + 1]) / sinc_width
+            if u == 0:
+                model += theta[3 * i]
+            else:
+                model += theta[3 * i] * math.sin(u) / u
+        res = spectrum[j] - model
+        acc += res * res
+    return -0.5 * acc / sigma2 + math.log(2 * math.pi * sigma2)
+
+
+# The observed spectrum and the fit vector are stored in single precision (the fit vector of the frozen models is in
+# double precision) so we declare every combination of single and double precision arrays. Declaring the signatures
+# compiles the kernel eagerly at import (and reads it back from the cache on later imports) so the first fit does not
+# pay the compilation cost. Other array types must be converted before calling the kernel (see Fit.calc_chisquare).
+CHI_SQUARE_SIGNATURES = ['UniTuple(float64, 2)(float32[:], float32[:], int64, int64, float64, float64)',
+                         'UniTuple(float64, 2)(float32[:], float64[:], int64, int64, float64, float64)',
+                         'UniTuple(float64, 2)(float64[:], float32[:], int64, int64, float64, float64)',
+                         'UniTuple(float64, 2)(float64[:], float64[:], int64, int64, float64, float64)']
+
+
+@njit(CHI_SQUARE_SIGNATURES, fastmath=True, cache=True, boundscheck=False, nogil=True, error_model='numpy')
+def chi_square(fit_vector, init_spectrum, min_restricted, max_restricted, norm, inv_dof):
+    """
+    Calculate the chi squared and the reduced chi squared over the restricted region in a single pass
+    (see Fit.calc_chisquare)
+
+    Args:
+        fit_vector: Spectrum obtained from fit
+        init_spectrum: Observed spectrum
+        min_restricted: Index of the start of the restricted region
+        max_restricted: Index of the end of the restricted region (exclusive)
+        norm: Normalization of the squared residuals (errors on the observed spectrum times the spectrum scale)
+        inv_dof: Inverse of the number of degrees of freedom of the fit
+
+    Return:
+        Chi squared value and reduced chi squared value
+    """
+    acc = 0.0  # The residuals are accumulated in double precision even if the inputs are single precision
+    for j in range(min_restricted, max_restricted):
+        res = np.float64(init_spectrum[j]) - np.float64(fit_vector[j])
+        acc += res * res
+    chi2 = acc / norm
+    return chi2, chi2 * inv_dof
+
+
+@njit(fastmath=True, cache=True, parallel=True, nogil=True)
+def gaussian_spectrum(axis, ampls, centers, sigmas, out):
+    """
+    Evaluate a sum of gaussian functions on the spectral axis. The axis is split between threads and
+    each thread loops over the lines for its own points.
+
+    Args:
+        axis: Wavelength Axis in cm-1
+        ampls: Amplitude of each line
+        centers: Position of each line
+        sigmas: Sigma of each line
+        out: Array in which to write the spectrum
+
+    Return:
+        Spectrum (out)
+    """
+    if out.shape[0] != axis.shape[0]:
+        raise ValueError('out must have the same length as the axis')
+    for j in prange(axis.shape[0]):
+        acc = 0.0
+        for i in range(ampls.shape[0]):
+            u = (axis[j] - centers[i]) / sigmas[i]
+            acc += ampls[i] * math.exp(-0.5 * u * u)
+        out[j] = acc
+    return out
+
+
+@njit(fastmath=True, cache=True, parallel=True, nogil=True)
+def sinc_spectrum(axis, ampls, centers, sinc_width, out):
+    """
+    Evaluate a sum of sinc functions on the spectral axis. The axis is split between threads and
+    each thread loops over the lines for its own points.
+
+    Args:
+        axis: Wavelength Axis in cm-1
+        ampls: Amplitude of each line
+        centers: Position of each line
+        sinc_width: Fixed width of the sinc function
+        out: Array in which to write the spectrum
+
+    Return:
+        Spectrum (out)
+    """
+    if out.shape[0] != axis.shape[0]:
+        raise ValueError('out must have the same length as the axis')
+    for j in prange(axis.shape[0]):
+        acc = 0.0
+        for i in range(ampls.shape[0]):
+            u = math.pi * (axis[j] - centers[i]) / sinc_width
+            if u == 0:
+                acc += ampls[i]
+            else:
+                acc += ampls[i] * math.sin(u) / u
+        out[j] = acc
+    return out
+
+
+# The Dawson function of a complex argument is not available in numba so there is no sincgauss kernel: the model is
+# evaluated with scipy and only the reduction is done in log_likelihood_residual
+LOG_LIKELIHOOD_KERNELS = {'gaussian': log_likelihood_gaussian, 'sinc': log_likelihood_sinc}
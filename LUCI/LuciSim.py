@@ -2,8 +2,10 @@
 Suite of simulations tools in LUCI
 """
 
+import math
 import numpy as np
-from LUCI.LuciFunctions import Gaussian, Sinc, SincGauss
+from LUCI.LuciFunctions import Gaussian, Sinc, SincGauss, nearest_index
+from LUCI.LuciKernels import gaussian_spectrum, sinc_spectrum
 
 
 class Spectrum:
@@ -97,7 +99,7 @@ class Spectrum:
         Calculate sinc width of the sincgauss function
 
         """
-        MPD = np.cos(np.deg2rad(self.theta))*self.delta_x*(self.n_steps-self.zpd_index)/1e7
+        MPD = math.cos(math.radians(self.theta))*self.delta_x*(self.n_steps-self.zpd_index)/1e7
         self.sinc_width = 1/(2*MPD)
 
     def gaussian_model(self, channel, amp, pos, sigma):
@@ -153,48 +155,61 @@ class Spectrum:
         f1 = SincGauss().evaluate(channel, [amp, pos, sigma], 1, self.sinc_width)
         return np.real(f1)
 
-    def create_spectrum(self):
+    def create_spectrum(self, out=None):
         """
         Create a mock spectrum given the lines of interest, the fitting function, the
         amplitudes of the lines, the kinematics of the lines, and the interferometer parameters.
         The interferometer parameters (step, n_steps, order & theta) will be used to construct the x-axis.
         We add noise given the snr value provided by sampling from a normal distribution with a sigma=1.
 
+        Args:
+            out: Array of length n_steps in which to write the spectrum so that it can be reused when creating many
+                spectra (default None creates a new array)
 
+        Return:
+            Wavelength axis in cm-1 and mock spectrum
         """
 
-        # Calculate correction factor
-        corr = 1/np.cos(np.deg2rad(self.theta))
+        corr = 1 / math.cos(math.radians(self.theta))  # Correction factor for the interferometer angle
         # Construct x axis in units of cm-1
-        x_min = self.order/(2*self.delta_x) * corr * 1e7
-        x_max = (self.order+1)/(2*self.delta_x) * corr * 1e7
-        step_ = x_max - x_min
-        axis = np.array([x_min+j*step_/self.n_steps for j in range(self.n_steps)])
+        axis_scale = 0.5 / self.delta_x * corr * 1e7
+        x_min = self.order * axis_scale
+        x_max = (self.order+1) * axis_scale
+        axis = np.linspace(x_min, x_max, self.n_steps, endpoint=False)
         # Initiate spectrum
-        spectrum = np.zeros_like(axis)  # Set continuum of about 2
-        # Create emission lines
+        if out is None:
+            spectrum = np.zeros_like(axis)  # Set continuum of about 2
+        else:
+            if out.shape != (self.n_steps,) or not np.issubdtype(out.dtype, np.floating):
+                raise ValueError('out must be a floating point array of shape ({},) but has shape {} and dtype {}'.format(
+                    self.n_steps, out.shape, out.dtype))
+            spectrum = out
+            spectrum.fill(0.0)
+        # Calculate the amplitude, position & sigma of each emission line
+        ampls = np.zeros(self.line_num)
+        line_positions = np.zeros(self.line_num)
+        sigmas = np.zeros(self.line_num)
         for line_ct, line in enumerate(self.lines):
             line_lambda_cm = (1e7 / self.line_dict[line])/(1+self.redshift)  # Convert from nm to cm-1
             vel_ = self.velocity[line_ct]  # Get velocity
             broad_ = self.broadening[line_ct]  # Get broadening
-            amp_ = self.ampls[line_ct]  # Get amplitude
+            ampls[line_ct] = self.ampls[line_ct]  # Get amplitude
             # Calculate position of line given velocity & match to closest point on axis
             line_pos = (vel_/3e5)*line_lambda_cm + line_lambda_cm
-            min_ind = np.argmin(np.abs(axis - line_pos))
-            line_pos = axis[min_ind]
+            line_positions[line_ct] = axis[nearest_index(axis, line_pos)]
             # Calculate sigma given broadening
-            sigma = (broad_*line_pos)/(3e5*corr)
-            # Create spectrum
-            if self.fit_function == 'gaussian':
-                spectrum += self.gaussian_model(axis, amp_, line_pos, sigma)
-            elif self.fit_function == 'sinc':
-                spectrum += self.sinc_model(axis, amp_, line_pos, sigma)
-            elif self.fit_function == 'sincgauss':
-                self.calc_sinc_width()
-                spectrum += self.sincgauss_model(axis, amp_, line_pos, sigma)
-            else:
-                print('An incorrect fit function was entered. Please use either gaussian, sinc, or sincgauss.')
-            #print(np.max(spectrum))
+            sigmas[line_ct] = (broad_*line_positions[line_ct])/(3e5*corr)
+        # Create spectrum
+        if self.fit_function == 'gaussian':
+            gaussian_spectrum(axis, ampls, line_positions, sigmas, spectrum)
+        elif self.fit_function == 'sinc':
+            sinc_spectrum(axis, ampls, line_positions, self.sinc_width, spectrum)
+        elif self.fit_function == 'sincgauss':
+            # The Dawson function of a complex argument is not available in numba
+            theta = np.column_stack((ampls, line_positions, sigmas)).ravel()
+            spectrum[:] = np.real(SincGauss().evaluate(axis, theta, self.line_num, self.sinc_width))
+        else:
+            print('An incorrect fit function was entered. Please use either gaussian, sinc, or sincgauss.')
         # We now add noise with our predefined SNR
         spectrum += np.max(spectrum)*np.random.normal(0.0,1/self.snr,spectrum.shape)
         return axis, spectrum
@@ -210,10 +225,10 @@ class Spectrum:
         Else it will throw an error
 
         """
-        if set(self.lines).issubset(self.line_dict):
-            pass
-        else:
-            raise Exception('Please submit a line name in the available list: \n {}'.format(self.line_dict.keys()))
+        missing = [line for line in self.lines if line not in self.line_dict]
+        if missing:
+            raise Exception('The lines {} are not available. Please submit a line name in the available list: \n {}'.format(
+                missing, list(self.line_dict)))
 
     def check_fitting_model(self):
         """
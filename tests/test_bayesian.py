@@ -0,0 +1,66 @@
+"""
+Suite of tests for the Bayesian functions. The log likelihood, log prior, and log probability are evaluated for all
+the walkers at once when emcee is vectorized so we check that they match the evaluation for each walker separately.
+"""
+import numpy as np
+
+from LUCI.LuciFunctions import Gaussian
+from LUCI.LuciBayesian import log_likelihood_bayes, log_prior, log_probability
+
+
+class Test:
+    def __init__(self):
+        self.axis = np.linspace(14750, 15400, 500)
+        self.lines = ['Halpha', 'NII6583']
+        self.line_dict = {'Halpha': 656.280, 'NII6583': 658.341}
+        self.line_num = 2
+        self.sinc_width = 1 / (2 * (2943 * (842 - 169) / 1e7))
+        self.noise = 1e-2
+        self.prior_gauss = [68.55, 0.8, 20.0, 0.1]  # [mu_vel, mu_broad, sigma_vel, sigma_broad]
+        positions = [1e7 / ((68.55 / 3e5) * self.line_dict[line] + self.line_dict[line]) for line in self.lines]
+        self.theta = np.array([0.9, positions[0], 0.8, 0.3, positions[1], 0.8, 0.05])
+        self.spectrum = Gaussian().evaluate(self.axis, self.theta, self.line_num) + self.theta[-1] + \
+            np.random.default_rng(0).normal(0, self.noise, len(self.axis))
+        # Walkers scattered around the solution; the last walker has an amplitude outside of the prior
+        self.walkers = self.theta + np.random.default_rng(1).normal(0, 1e-2, (8, len(self.theta)))
+        self.walkers[-1, 0] = 2.0
+
+    def check_vectorized(self, function, *args):
+        """
+        Check that evaluating the function for all the walkers matches evaluating it for each walker
+        """
+        vectorized = function(self.walkers, *args)
+        scalar = np.array([function(walker, *args) for walker in self.walkers])
+        assert vectorized.shape == (len(self.walkers),)
+        assert np.allclose(vectorized, scalar, equal_nan=True)
+
+
+def test_log_likelihood_bayes():
+    """
+    Test that the vectorized log likelihood matches the per walker log likelihood for each model
+    """
+    Test_ = Test()
+    for model_type in ['gaussian', 'sinc', 'sincgauss']:
+        Test_.check_vectorized(log_likelihood_bayes, Test_.axis, Test_.spectrum, Test_.noise, model_type,
+                               Test_.line_num, Test_.sinc_width, [1, 1], [1, 1])
+
+
+def test_log_prior():
+    """
+    Test that the vectorized log prior matches the per walker log prior
+    """
+    Test_ = Test()
+    Test_.check_vectorized(log_prior, Test_.axis, Test_.line_num, Test_.lines, Test_.line_dict, *Test_.prior_gauss)
+    assert np.isinf(log_prior(Test_.walkers[-1], Test_.axis, Test_.line_num, Test_.lines, Test_.line_dict,
+                               *Test_.prior_gauss))
+
+
+def test_log_probability():
+    """
+    Test that the vectorized log probability matches the per walker log probability for each model
+    """
+    Test_ = Test()
+    for model_type in ['gaussian', 'sinc', 'sincgauss']:
+        Test_.check_vectorized(log_probability, Test_.axis, Test_.spectrum, Test_.noise, model_type, Test_.line_num,
+                               Test_.lines, Test_.line_dict, Test_.sinc_width, Test_.prior_gauss, [1, 1], [1, 1],
+                               True)
@@ -3,12 +3,14 @@ Suite of tests for Luci fitting function on a single synthetic spectrum just to
 giving crazy values!
 """
 import numpy as np
+import pytest
 from astropy.io import fits
 from scipy import interpolate
 
 from LUCI.LuciFit import Fit
 from LUCI.LuciFunctions import Gaussian
 from LUCI.LuciFitParameters import calculate_vel, calculate_broad
+from tests.test_functions import finite_difference
 
 
 class Test:
@@ -42,6 +44,64 @@ class Test:
                             [1] * len(self.lines), [1] * len(self.lines), self.ML_model, self.transmission_interpolated)
         self.LuciFit_.interpolate_spectrum()
 
+    def luci_fit_ties(self, model_type):
+        """
+        Set up a fit of several lines with tied velocities, tied broadenings, and the NII doublet constraint.
+        The free parameters are taken close to an initial guess for the parameter elimination tests.
+
+        Args:
+            model_type: Fitting function (i.e. 'gaussian', 'sinc', or 'sincgauss')
+        """
+        self.lines = ['Halpha', 'NII6583', 'NII6548', 'SII6716']
+        self.axis = np.linspace(14400, 15800, 842)
+        positions = [1e7 / ((60 / 299792) * self.line_dict[line] + self.line_dict[line]) for line in self.lines]
+        self.spectrum = Gaussian().evaluate(self.axis, np.ravel([[1, pos, 1.2] for pos in positions]), 4) + 0.05
+        self.LuciFit_ = Fit(self.spectrum, self.axis, None, model_type, self.lines, [1, 1, 1, 2], [1, 2, 2, 1],
+                            None)
+        initial = np.append(np.ravel([[0.8, pos, 1.0] for pos in positions]), 0.04)
+        self.LuciFit_.initial_values = initial
+        self.LuciFit_.setup_parameter_ties()
+        self.params_free = initial[self.LuciFit_.free_params] * (1 + 1e-3 * np.arange(len(self.LuciFit_.free_params)))
+
+    def test_parameter_ties(self):
+        """
+        Check that the parameters calculated from the free parameters satisfy the velocity, broadening, and NII ties
+        """
+        theta = self.LuciFit_.expand_parameters(self.params_free)[0]
+        rest = np.array([self.line_dict[line] for line in self.lines])
+        positions, sigmas = theta[1:-1:3], theta[2:-1:3]
+        # Equal velocities means equal position * rest wavelength in a group
+        assert np.allclose(positions[:3] * rest[:3], positions[0] * rest[0])
+        # Equal broadening means equal sigma / position in a group
+        assert np.isclose(sigmas[1] / positions[1], sigmas[2] / positions[2])
+        assert np.isclose(sigmas[0] / positions[0], sigmas[3] / positions[3])
+        # NII6583 is three times stronger than NII6548
+        weight_6583 = self.LuciFit_.nii_weight(sigmas[1])[0]
+        weight_6548 = self.LuciFit_.nii_weight(sigmas[2])[0]
+        assert np.isclose(theta[3] * weight_6583, 3 * theta[6] * weight_6548)
+
+    def test_parameter_jacobians(self):
+        """
+        Check that the derivative of the parameters and the jacobian of the residuals with respect to the free
+        parameters match finite differences
+        """
+        param_jac = self.LuciFit_.expand_parameters(self.params_free)[1]
+        expand = lambda params: self.LuciFit_.expand_parameters(params)[0]
+        assert np.allclose(param_jac, finite_difference(expand, self.params_free), atol=1e-6)
+        residuals_jac = self.LuciFit_.residuals_jacobian(self.params_free)
+        assert np.allclose(residuals_jac, finite_difference(self.LuciFit_.residuals, self.params_free), atol=1e-5)
+
+    def test_parameter_jacobian_zero_amplitude(self):
+        """
+        Check that the derivative of the tied NII6548 amplitude is finite and matches finite differences when the
+        NII6583 amplitude is zero
+        """
+        self.params_free[list(self.LuciFit_.free_params).index(3)] = 0.0  # NII6583 amplitude
+        param_jac = self.LuciFit_.expand_parameters(self.params_free)[1]
+        assert np.all(np.isfinite(param_jac))
+        expand = lambda params: self.LuciFit_.expand_parameters(params)[0]
+        assert np.allclose(param_jac, finite_difference(expand, self.params_free), atol=1e-6)
+
     def read_in_transmission(self):
         """
         Read in the transmission spectrum for the filter. Then apply interpolation
@@ -92,10 +152,74 @@ class Test:
         # Check that velocity of the fit is within 10% of the true value which is 68.55 km/s
         assert np.abs((calculate_vel(0, self.lines, self.LuciFit_.fit_sol, self.line_dict) - 68.55)/68.55) < 1.1
         # Check that broadening of the fit is within 10% of the true value which is 9.85 km/s
-        # Convert broadening by dividing by FWHM
-        sigma_real = 9.85/(2*np.sqrt(2*np.log(2)))
+        # calculate_broad returns the gaussian sigma in km/s (no FWHM correction)
+        sigma_real = 9.85
         assert np.abs((calculate_broad(0, self.LuciFit_.fit_sol, self.LuciFit_.axis_step) - sigma_real)/sigma_real) < 1.1
 
+    def test_calc_chisquare(self):
+        """
+        Check the chi squared for different precisions of the fit vector and observed spectrum and for errors on
+        each channel against the numpy calculation
+        """
+        fit = self.LuciFit_
+        fit.fit()
+        lo, hi = fit.min_restricted, fit.max_restricted
+        init_spectrum = self.spectrum + np.random.default_rng(0).normal(0, 1e-2, len(self.spectrum))
+        for fit_dtype in [np.float32, np.float64]:
+            for spec_dtype in [np.float32, np.float64, np.int64]:
+                fit_vector, spectrum = fit.fit_vector.astype(fit_dtype), (init_spectrum * 100).astype(spec_dtype)
+                residuals = spectrum[lo:hi] - fit_vector[lo:hi].astype(np.float64)
+                chi2 = np.sum(residuals ** 2) / (1e-2 * fit.spectrum_scale)
+                chi2_fit, chi2dof_fit = fit.calc_chisquare(fit_vector, spectrum, 1e-2, 4)
+                assert np.isclose(chi2_fit, chi2)
+                assert np.isclose(chi2dof_fit, chi2 / (hi - lo - 4))
+        errors = np.full(hi - lo, 1e-2)
+        errors[::2] = 2e-2
+        chi2 = np.sum((init_spectrum[lo:hi] - fit.fit_vector[lo:hi]) ** 2 / (errors * fit.spectrum_scale))
+        assert np.isclose(fit.calc_chisquare(fit.fit_vector, init_spectrum, errors, 4)[0], chi2)
+
+    def test_fit_vector_kept(self):
+        """
+        Fit the same spectrum twice and check that the fit vector returned by the first fit is not overwritten
+        """
+        fit_vector = self.LuciFit_.fit()['fit_vector']
+        fit_vector_copy = fit_vector.copy()
+        self.LuciFit_.spectrum_restricted = self.LuciFit_.spectrum_restricted * 0.5
+        assert self.LuciFit_.fit()['fit_vector'] is not fit_vector
+        assert np.array_equal(fit_vector, fit_vector_copy)
+
+    def test_fit_zero_broadening(self):
+        """
+        Fit a single Halpha line without a machine learning model so that the initial broadening is zero. The
+        initial sigma must be clipped to a positive value so that the fit can start.
+        """
+        self.LuciFit_.fit()
+        assert self.LuciFit_.broad_ml == 0
+        assert self.LuciFit_.initial_values[2] > 0
+        assert np.all(np.isfinite(self.LuciFit_.fit_sol))
+
+    def test_fit_zero_spectrum(self):
+        """
+        Fit a pixel without any signal. The fit cannot be started so the solution should be NaN instead of raising
+        an error that would stop the fit of the entire cube.
+        """
+        LuciFit_ = Fit(np.zeros_like(self.axis), self.axis, self.wavenumbers_syn, self.model_type, self.lines,
+                       [1] * len(self.lines), [1] * len(self.lines), self.ML_model, self.transmission_interpolated)
+        LuciFit_.fit()
+        assert np.all(np.isnan(LuciFit_.fit_sol))
+
+    def test_interpolate_outside_axis(self):
+        """
+        Interpolate a spectrum whose axis does not cover the reference axis of the machine learning model. This must
+        raise an error instead of filling the missing points with the edge values.
+        """
+        inside = self.axis > 15000
+        LuciFit_ = Fit(self.spectrum[inside], self.axis[inside], self.wavenumbers_syn, self.model_type, self.lines,
+                       [1] * len(self.lines), [1] * len(self.lines), self.ML_model,
+                       self.transmission_interpolated[inside])
+        with pytest.raises(ValueError):
+            LuciFit_.interpolate_spectrum()
+
     def test_ML_single(self):
         """
         Fit a single Halpha line. We then check that the amplitude, velocity, and broadening found by our machine learning algorithm
@@ -129,6 +253,81 @@ def test_fit_single():
     Test_.test_fit_single()
 
 
+def test_calc_chisquare():
+    """
+    Test to call Test.test_calc_chisquare
+    """
+    Test_ = Test()
+    Test_.luci_fit_single()
+    Test_.test_calc_chisquare()
+
+
+def test_fit_vector_kept():
+    """
+    Test to call Test.test_fit_vector_kept
+    """
+    Test_ = Test()
+    Test_.luci_fit_single()
+    Test_.test_fit_vector_kept()
+
+
+def test_fit_zero_broadening():
+    """
+    Test to call Test.test_fit_zero_broadening
+    """
+    Test_ = Test()
+    Test_.luci_fit_single()
+    Test_.test_fit_zero_broadening()
+
+
+def test_fit_zero_spectrum():
+    """
+    Test to call Test.test_fit_zero_spectrum
+    """
+    Test_ = Test()
+    Test_.luci_fit_single()
+    Test_.test_fit_zero_spectrum()
+
+
+def test_parameter_ties():
+    """
+    Test to call Test.test_parameter_ties for each model
+    """
+    for model_type in ['gaussian', 'sinc', 'sincgauss']:
+        Test_ = Test()
+        Test_.luci_fit_ties(model_type)
+        Test_.test_parameter_ties()
+
+
+def test_parameter_jacobians():
+    """
+    Test to call Test.test_parameter_jacobians for each model
+    """
+    for model_type in ['gaussian', 'sinc', 'sincgauss']:
+        Test_ = Test()
+        Test_.luci_fit_ties(model_type)
+        Test_.test_parameter_jacobians()
+
+
+def test_parameter_jacobian_zero_amplitude():
+    """
+    Test to call Test.test_parameter_jacobian_zero_amplitude for each model
+    """
+    for model_type in ['gaussian', 'sinc', 'sincgauss']:
+        Test_ = Test()
+        Test_.luci_fit_ties(model_type)
+        Test_.test_parameter_jacobian_zero_amplitude()
+
+
+def test_interpolate_outside_axis():
+    """
+    Test to call Test.test_interpolate_outside_axis
+    """
+    Test_ = Test()
+    Test_.luci_fit_single()
+    Test_.test_interpolate_outside_axis()
+
+
 def test_ML_single():
     """
     Test to call Test.test_ML_single
@@ -0,0 +1,95 @@
+"""
+Suite of tests for the model functions in LuciFunctions. We check the analytic jacobians used by the fit against
+central finite differences of the models and the axis lookups against a brute force search.
+"""
+import numpy as np
+
+from LUCI.LuciFunctions import Gaussian, Sinc, SincGauss, nearest_index
+
+
+def finite_difference(function, params, step=1e-6):
+    """
+    Derivative of a function calculated with central finite differences. This is the reference for the analytic
+    jacobians of the models (here) and of the least squares fit (test_fit).
+
+    Args:
+        function: Function of the parameters returning an array
+        params: Parameters at which the derivative is calculated
+        step: Absolute step size
+
+    Return:
+        Array of partial derivatives with the parameters along the last axis
+    """
+    derivatives = []
+    for param in range(len(params)):
+        params_up, params_down = params.copy(), params.copy()
+        params_up[param] += step
+        params_down[param] -= step
+        derivatives.append((function(params_up) - function(params_down)) / (2 * step))
+    return np.stack(derivatives, axis=-1)
+
+
+class Test:
+    def __init__(self):
+        self.axis = np.linspace(14750, 15400, 500)
+        self.theta = np.array([1.0, 15234.0, 0.9, 0.3, 15200.0, 1.2])
+        self.line_num = 2
+        self.sinc_width = 1 / (2 * (2943 * (842 - 169) / 1e7))
+
+    def finite_difference_jacobian(self, evaluate):
+        """
+        Reference jacobian of a model with shape (len(theta), len(axis)). The line positions are large so the step
+        is larger than the default one.
+
+        Args:
+            evaluate: Function of theta returning the model on the axis
+        """
+        return finite_difference(evaluate, self.theta, step=1e-5).T
+
+
+def test_jacobian_gaussian():
+    """
+    Test that the analytic jacobian of the Gaussian model matches finite differences
+    """
+    Test_ = Test()
+    jac = Gaussian().jacobian(Test_.axis, Test_.theta, Test_.line_num)
+    jac_fd = Test_.finite_difference_jacobian(lambda theta: Gaussian().evaluate(Test_.axis, theta, Test_.line_num))
+    assert np.allclose(jac, jac_fd, atol=1e-6)
+
+
+def test_jacobian_sinc():
+    """
+    Test that the analytic jacobian of the Sinc model matches finite differences
+    """
+    Test_ = Test()
+    jac = Sinc().jacobian(Test_.axis, Test_.theta, Test_.line_num, Test_.sinc_width)
+    jac_fd = Test_.finite_difference_jacobian(lambda theta: Sinc().evaluate(Test_.axis, theta, Test_.line_num,
+                                                                            Test_.sinc_width))
+    assert np.allclose(jac, jac_fd, atol=1e-6)
+
+
+def test_jacobian_sincgauss():
+    """
+    Test that the analytic jacobian of the SincGauss model matches finite differences
+    """
+    Test_ = Test()
+    jac = SincGauss().jacobian(Test_.axis, Test_.theta, Test_.line_num, Test_.sinc_width)
+    jac_fd = Test_.finite_difference_jacobian(lambda theta: SincGauss().evaluate(Test_.axis, theta, Test_.line_num,
+                                                                                 Test_.sinc_width))
+    assert np.allclose(jac, jac_fd, atol=1e-6)
+
+
+def test_nearest_index():
+    """
+    Test that nearest_index matches np.argmin(np.abs(channel - value)) on increasing and decreasing axes
+    """
+    Test_ = Test()
+    # Values outside of the axis, on the axis points, and halfway between two points
+    values = np.concatenate(([14000.0, 16000.0], Test_.axis[::37], (Test_.axis[:-1:41] + Test_.axis[1::41]) / 2,
+                             np.random.default_rng(0).uniform(14700, 15450, 100)))
+    for channel in (Test_.axis, Test_.axis[::-1], np.arange(10.0), np.arange(10.0)[::-1]):
+        if channel[0] < 10:  # Exact ties between two points
+            values = np.arange(-1.0, 11.0, 0.5)
+        expected = [np.argmin(np.abs(channel - value)) for value in values]
+        assert np.array_equal(nearest_index(channel, values), expected)
+        assert nearest_index(channel, values[5]) == expected[5]
@@ -0,0 +1,141 @@
+"""
+Suite of tests for the numba kernels used by the fitting function. We check that each kernel agrees
+with the equivalent calculation done with the model classes in LuciFunctions.
+"""
+import numpy as np
+import pytest
+
+from LUCI.LuciFunctions import Gaussian, Sinc, SincGauss
+from LUCI.LuciKernels import log_likelihood_gaussian, log_likelihood_sinc, log_likelihood_residual, chi_square, \
+    gaussian_spectrum, sinc_spectrum
+
+
+class Test:
+    def __init__(self):
+        self.axis = np.linspace(14750, 15400, 500)
+        self.theta = np.array([1.0, 15234.0, 0.5, 0.3, 15200.0, 0.8, 0.05])
+        self.line_num = 2
+        self.sinc_width = 1 / (2 * (2943 * (842 - 169) / 1e7))
+        self.noise = 1e-2
+        self.spectrum = Gaussian().evaluate(self.axis, self.theta, self.line_num) + 0.05
+
+    def log_likelihood(self, model):
+        """
+        Reference log likelihood calculated with numpy
+        """
+        sigma2 = self.noise ** 2
+        return -0.5 * np.sum((self.spectrum - model - self.theta[-1]) ** 2 / sigma2) + np.log(2 * np.pi * sigma2)
+
+
+def test_log_likelihood_gaussian():
+    """
+    Test that the gaussian kernel matches the Gaussian model
+    """
+    Test_ = Test()
+    model = Gaussian().evaluate(Test_.axis, Test_.theta, Test_.line_num)
+    ll = log_likelihood_gaussian(Test_.axis, Test_.spectrum, Test_.theta, Test_.line_num, Test_.sinc_width, Test_.noise)
+    assert np.isclose(ll, Test_.log_likelihood(model))
+
+
+def test_log_likelihood_sinc():
+    """
+    Test that the sinc kernel matches the Sinc model
+    """
+    Test_ = Test()
+    model = Sinc().evaluate(Test_.axis, Test_.theta, Test_.line_num, Test_.sinc_width)
+    ll = log_likelihood_sinc(Test_.axis, Test_.spectrum, Test_.theta, Test_.line_num, Test_.sinc_width, Test_.noise)
+    assert np.isclose(ll, Test_.log_likelihood(model))
+
+
+def test_log_likelihood_residual():
+    """
+    Test that the residual kernel used for the sincgauss model matches the SincGauss model
+    """
+    Test_ = Test()
+    model = SincGauss().evaluate(Test_.axis, Test_.theta, Test_.line_num, Test_.sinc_width)
+    ll = log_likelihood_residual(Test_.spectrum, model + Test_.theta[-1], Test_.noise)
+    assert np.isclose(ll, Test_.log_likelihood(model))
+
+
+def test_chi_square():
+    """
+    Test that the chi squared kernel matches the numpy calculation over the restricted region
+    """
+    Test_ = Test()
+    fit_vector = Gaussian().evaluate(Test_.axis, Test_.theta, Test_.line_num) + Test_.theta[-1]
+    init_spectrum = Test_.spectrum + np.random.default_rng(0).normal(0, Test_.noise, len(Test_.axis))
+    chi2 = np.sum((init_spectrum[100:400] - fit_vector[100:400]) ** 2 / (Test_.noise * 2.0))
+    chi2_kernel, chi2dof_kernel = chi_square(fit_vector, init_spectrum, 100, 400, Test_.noise * 2.0, 1 / 293)
+    assert np.isclose(chi2_kernel, chi2)
+    assert np.isclose(chi2dof_kernel, chi2 / 293)
+
+
+def test_gaussian_spectrum():
+    """
+    Test that the parallel gaussian kernel matches the Gaussian model
+    """
+    Test_ = Test()
+    theta = Test_.theta[:-1]
+    out = gaussian_spectrum(Test_.axis, theta[0::3], theta[1::3], theta[2::3], np.empty(len(Test_.axis)))
+    assert np.allclose(out, Gaussian().evaluate(Test_.axis, theta, Test_.line_num))
+
+
+def test_sinc_spectrum():
+    """
+    Test that the parallel sinc kernel matches the Sinc model
+    """
+    Test_ = Test()
+    theta = Test_.theta[:-1]
+    out = sinc_spectrum(Test_.axis, theta[0::3], theta[1::3], Test_.sinc_width, np.empty(len(Test_.axis)))
+    assert np.allclose(out, Sinc().evaluate(Test_.axis, theta, Test_.line_num, Test_.sinc_width))
+
+
+def test_spectrum_out_length():
+    """
+    Test that the parallel kernels refuse an output array that does not match the axis instead of writing past its end
+    """
+    Test_ = Test()
+    theta = Test_.theta[:-1]
+    buffer = np.zeros(len(Test_.axis) + 10)
+    with pytest.raises(ValueError):
+        gaussian_spectrum(Test_.axis, theta[0::3], theta[1::3], theta[2::3], buffer[:10])
+    with pytest.raises(ValueError):
+        sinc_spectrum(Test_.axis, theta[0::3], theta[1::3], Test_.sinc_width, buffer[:10])
+    assert np.all(buffer == 0)
+
+
+def test_chi_square_single_precision():
+    """
+    Test that the chi squared kernel gives the double precision result for single precision spectra
+    """
+    Test_ = Test()
+    fit_vector = Gaussian().evaluate(Test_.axis, Test_.theta, Test_.line_num) + Test_.theta[-1]
+    init_spectrum = Test_.spectrum + np.random.default_rng(0).normal(0, Test_.noise, len(Test_.axis))
+    fit_vector, init_spectrum = fit_vector.astype(np.float32), init_spectrum.astype(np.float32)
+    residuals = init_spectrum[100:400].astype(np.float64) - fit_vector[100:400].astype(np.float64)
+    chi2 = np.sum(residuals ** 2 / (Test_.noise * 2.0))
+    assert np.isclose(chi_square(fit_vector, init_spectrum, 100, 400, Test_.noise * 2.0, 1.0)[0], chi2, rtol=1e-12)
+
+
+def test_log_likelihood_zero_division():
+    """
+    Test that a zero sigma or a zero noise does not raise a ZeroDivisionError (numpy semantics instead)
+    """
+    Test_ = Test()
+    theta = Test_.theta.copy()
+    theta[2] = 0.0
+    log_likelihood_gaussian(Test_.axis, Test_.spectrum, theta, Test_.line_num, Test_.sinc_width, Test_.noise)
+    for kernel in (log_likelihood_gaussian, log_likelihood_sinc):
+        ll = kernel(Test_.axis, Test_.spectrum, Test_.theta, Test_.line_num, Test_.sinc_width, 0.0)
+        assert not np.isfinite(ll)
+    assert not np.isfinite(log_likelihood_residual(Test_.spectrum, Test_.spectrum + 1.0, 0.0))
+
+
+def test_chi_square_zero_noise():
+    """
+    Test that a zero noise (e.x. a flat noise region) does not raise a ZeroDivisionError (numpy semantics instead)
+    """
+    Test_ = Test()
+    fit_vector = Gaussian().evaluate(Test_.axis, Test_.theta, Test_.line_num) + Test_.theta[-1]
+    chi2, chi2dof = chi_square(fit_vector, Test_.spectrum + 1.0, 100, 400, 0.0, 1 / 293)
+    assert np.isinf(chi2) and np.isinf(chi2dof)